@@ -0,0 +1,238 @@
+"""
+Benchmark of the OpenTTD protocol codec.
+
+Measures every packet decoder and encoder, the packet reader and writer
+primitives, framing of a stream of packets, and sending the server listing
+(compared with sending every server in a packet of its own). For every
+case it reports the time and the peak memory allocated per operation; for
+the listing also the packets and bytes sent. Results can be saved, and compared with earlier results:
+
+    python -m benchmarks.codec --save before.json
+    python -m benchmarks.codec --compare before.json
+"""
+
+import asyncio
+import click
+import json
+import platform
+import timeit
+import tracemalloc
+
+from game_coordinator.openttd.protocol.enums import PacketTCPCoordinatorType
+from game_coordinator.openttd.protocol.read import PacketReader
+from game_coordinator.openttd.protocol.write import PacketWriter
+from game_coordinator.openttd.receive import OpenTTDProtocolCoordinatorReceive
+
+from . import corpus
+
+
+def _reader_cases():
+    data = bytes(range(32)) + b"openttd.example.com\x00"
+
+    def read(method, *args):
+        return lambda: getattr(PacketReader(data), method)(*args)
+
+    return {
+        "read.uint8": read("read_uint8"),
+        "read.uint16": read("read_uint16"),
+        "read.uint32": read("read_uint32"),
+        "read.uint64": read("read_uint64"),
+        "read.bytes16": read("read_bytes", 16),
+        "read.string": lambda: PacketReader(data, 32).read_string(),
+    }
+
+
+def _writer_cases():
+    def write(method, value):
+        def case():
+            writer = PacketWriter(1)
+            getattr(writer, method)(value)
+            return writer.finish()
+
+        return case
+
+    return {
+        "write.uint8": write("write_uint8", 1),
+        "write.uint16": write("write_uint16", 1),
+        "write.uint32": write("write_uint32", 1),
+        "write.uint64": write("write_uint64", 1),
+        "write.bytes16": write("write_bytes", bytes(16)),
+        "write.string": write("write_string", "openttd.example.com"),
+    }
+
+
+def _decoder_cases():
+    cases = {}
+    for cls, type, data in corpus.received_packets():
+        # Timed per amount of NewGRFs, below.
+        if type is PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_UPDATE:
+            continue
+
+        receiver = corpus.create_receiver(cls)
+        cases[f"receive.{type.name}"] = lambda receiver=receiver, data=data: receiver.receive_packet(
+            corpus.SOURCE, data
+        )
+
+    receiver = corpus.create_receiver(OpenTTDProtocolCoordinatorReceive)
+    for newgrfs in corpus.NEWGRF_COUNTS:
+        data = corpus.client_update(newgrfs)
+        cases[f"receive.PACKET_COORDINATOR_CLIENT_UPDATE.{newgrfs}-newgrfs"] = (
+            lambda data=data: receiver.receive_packet(corpus.SOURCE, data)
+        )
+    return cases
+
+
+def _framing_cases():
+    # A burst of small packets, as received in a single read; the time is
+    # per packet.
+    cls, _, packet = [entry for entry in corpus.received_packets() if "STUN_RESULT" in entry[1].name][0]
+    receiver = corpus.create_receiver(cls)
+    data = bytearray(packet * 100)
+
+    def dispatch(data, start, end):
+        receiver.receive_packet(corpus.SOURCE, data, start, end)
+
+    return {"framing.STUN_RESULT": (lambda: receiver.receive_data(dispatch, data, 0, len(data)), 100)}
+
+
+def _encoder_cases():
+    sender = corpus.Sender()
+
+    cases = {}
+    for name, args in corpus.SENT.items():
+        method = getattr(sender, f"send_{name}")
+        if asyncio.iscoroutinefunction(method):
+            cases[f"send.{name}"] = lambda method=method, args=args: corpus.run(method(*args))
+        else:
+            cases[f"send.{name}"] = lambda method=method, args=args: method(*args)
+    return cases
+
+
+class _CountingSender(corpus.Sender):
+    """Protocol that counts the packets and bytes sent, instead of sending them."""
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        self.packets = 0
+        self.bytes = 0
+
+    async def send_packet(self, data):
+        self.packets += 1
+        self.bytes += len(data)
+
+
+# Every listing case sends through this sender, so the traffic of a single
+# listing can be counted after timing it.
+_listing_sender = _CountingSender()
+
+# Amounts of servers to time the listing with.
+LISTING_SIZES = {"1k": 1000, "10k": 10000}
+
+
+def _send_listing(servers):
+    sender = _listing_sender
+    corpus.run(sender.send_PACKET_COORDINATOR_SERVER_LISTING(sender.encode_server_listing(servers)))
+
+
+async def _send_listing_per_server(servers):
+    # How the listing used to be sent: every server encoded for every
+    # listing, in a packet of its own.
+    sender = _listing_sender
+    for join_key, server in servers.items():
+        entry = sender._encode_server_listing_entry(join_key, server.info)
+        await sender.send_packet(sender._encode_PACKET_COORDINATOR_SERVER_LISTING([entry]))
+    await sender.send_packet(sender._encode_PACKET_COORDINATOR_SERVER_LISTING([]))
+
+
+def _listing_cases():
+    cases = {}
+    for label, count in LISTING_SIZES.items():
+        servers = corpus.servers(count)
+
+        def cold(servers=servers):
+            # As if every server just sent an update.
+            for server in servers.values():
+                server.listing_entry = None
+            _send_listing(servers)
+
+        cases[f"listing.{label}.per-server"] = lambda servers=servers: corpus.run(_send_listing_per_server(servers))
+        cases[f"listing.{label}.cold"] = cold
+        cases[f"listing.{label}.cached"] = lambda servers=servers: _send_listing(servers)
+    return cases
+
+
+def count_listing(func):
+    """The packets and bytes sent for a single listing."""
+
+    _listing_sender.reset()
+    func()
+    return {"packets": _listing_sender.packets, "bytes": _listing_sender.bytes}
+
+
+def get_cases():
+    cases = {}
+    for factory in (_reader_cases, _writer_cases, _decoder_cases, _framing_cases, _encoder_cases, _listing_cases):
+        cases.update(factory())
+
+    # Every case is (function, operations per call).
+    return {name: case if isinstance(case, tuple) else (case, 1) for name, case in cases.items()}
+
+
+def measure(func, operations, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    ns = min(timer.repeat(repeat=repeat, number=number)) / number / operations * 1e9
+
+    # Peak of what is allocated during a single call, so this includes
+    # memory that is freed again before the call returns.
+    tracemalloc.start()
+    try:
+        func()
+        tracemalloc.clear_traces()
+        base, _ = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"ns": ns, "alloc_bytes": max(peak - base, 0) / operations}
+
+
+@click.command()
+@click.option("--save", help="Save the results to this JSON file.", type=click.Path(dir_okay=False))
+@click.option("--compare", help="Compare with results saved earlier.", type=click.File())
+@click.option("--filter", "name_filter", help="Only run cases with this in their name.", default="")
+@click.option("--repeat", help="Take the best of this many runs.", default=5, show_default=True)
+def main(save, compare, name_filter, repeat):
+    baseline = json.load(compare)["results"] if compare else {}
+
+    results = {}
+    print(f"{'case':56} {'ns/op':>12} {'alloc B/op':>12}")
+    for name, (func, operations) in get_cases().items():
+        if name_filter not in name:
+            continue
+
+        result = measure(func, operations, repeat)
+        if name.startswith("listing."):
+            result.update(count_listing(func))
+        results[name] = result
+
+        line = f"{name:56} {result['ns']:12.0f} {result['alloc_bytes']:12.0f}"
+        if name in baseline:
+            line += f" {(result['ns'] / baseline[name]['ns'] - 1) * 100:+7.1f}%"
+        if "packets" in result:
+            line += f"  ({result['packets']} packets, {result['bytes']} bytes)"
+        print(line)
+
+    if save:
+        with open(save, "w") as f:
+            json.dump({"python": platform.python_version(), "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
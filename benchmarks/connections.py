@@ -0,0 +1,260 @@
+"""
+Benchmark of the coordinator protocol with many concurrent connections.
+
+Starts the coordinator in a separate process on loopback, and opens many
+connections to it. Reports the memory every idle connection takes (RSS,
+and what tracemalloc sees Python allocate), and how many packets per second
+a single core handles when all connections send a burst of packets.
+
+Packets are dispatched straight from the receive buffer; this is compared
+with how it was done before: a queue and a task per connection, with every
+packet copied into the queue and handled by the task. Framing and decoding
+are the same in both modes. Memory is read from /proc, so this only works
+on Linux:
+
+    python -m benchmarks.connections --connections 50000 --packets 20
+
+Both sides of every connection need a file descriptor; as the coordinator
+and the connections each run in their own process, the limit on open files
+has to be a bit above the amount of connections.
+"""
+
+import asyncio
+import click
+import json
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+from asyncio.coroutines import iscoroutine
+
+from game_coordinator.application.coordinator import Application as CoordinatorApplication
+from game_coordinator.openttd.protocol.enums import PacketTCPCoordinatorType
+from game_coordinator.openttd.protocol.packets import COORDINATOR_PACKETS
+from game_coordinator.openttd.protocol.schema import create_encoder
+from game_coordinator.openttd.tcp_coordinator import OpenTTDProtocolTCPCoordinator
+
+from . import corpus
+from .proc import (
+    get_cpu_time,
+    get_rss,
+)
+
+# A packet the coordinator handles without answering or waiting: a failure
+# for a connection attempt it doesn't know (any more).
+_type = PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECT_FAILED
+PACKET = create_encoder(COORDINATOR_PACKETS[_type], _type)(**corpus.COORDINATOR_RECEIVED[_type])
+
+# Connections opened at the same time.
+CONNECT_BATCH = 500
+# Seconds to wait for the coordinator to catch up, before giving up.
+WAIT_TIMEOUT = 120
+
+
+class Application(CoordinatorApplication):
+    """The coordinator, counting connections and handled packets."""
+
+    def __init__(self):
+        super().__init__()
+        self.connections = 0
+        self.handled = 0
+
+    def disconnect(self, source):
+        self.connections -= 1
+        super().disconnect(source)
+
+    def receive_PACKET_COORDINATOR_CLIENT_CONNECT_FAILED(self, source, protocol_version, token, tracking_number):
+        self.handled += 1
+        super().receive_PACKET_COORDINATOR_CLIENT_CONNECT_FAILED(source, protocol_version, token, tracking_number)
+
+
+class DirectProtocol(OpenTTDProtocolTCPCoordinator):
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self._callback.connections += 1
+
+
+class QueuedProtocol(DirectProtocol):
+    """
+    The protocol as it was: every connection has a queue and a task, and
+    every packet is copied into the queue, to be handled by the task.
+    """
+
+    def __init__(self, callback_class):
+        super().__init__(callback_class)
+
+        self._queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._process_queue())
+
+    def _dispatch_packet(self, data, start, end):
+        self._queue.put_nowait(bytes(data[start:end]))
+
+    async def _process_queue(self):
+        while True:
+            data = await self._queue.get()
+
+            handler = self._handle_packet(data, 0, len(data))
+            if iscoroutine(handler):
+                await handler
+
+
+MODES = {
+    "queue": QueuedProtocol,
+    "direct": DirectProtocol,
+}
+
+
+def _raise_open_files_limit():
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _serve(connection, mode):
+    _raise_open_files_limit()
+    application = Application()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(
+        loop.create_server(lambda: MODES[mode](application), host="127.0.0.1", port=0, backlog=CONNECT_BATCH)
+    )
+
+    def command():
+        name = connection.recv()
+        if name == "trace":
+            tracemalloc.start()
+
+        connection.send(
+            {
+                "connections": application.connections,
+                "handled": application.handled,
+                "rss": get_rss(),
+                "cpu_time": get_cpu_time(),
+                "traced": tracemalloc.get_traced_memory()[0],
+            }
+        )
+
+    loop.add_reader(connection.fileno(), command)
+    connection.send(server.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+
+class Coordinator:
+    """The coordinator, running in a process of its own."""
+
+    def __init__(self, mode):
+        context = multiprocessing.get_context("fork")
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(target=_serve, args=(child_connection, mode), daemon=True)
+        self._process.start()
+        self.port = self._connection.recv()
+
+    def query(self, command="stats"):
+        self._connection.send(command)
+        return self._connection.recv()
+
+    async def wait(self, condition):
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while True:
+            stats = self.query()
+            if condition(stats):
+                return stats
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"coordinator didn't catch up: {stats}")
+            await asyncio.sleep(0.05)
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+async def _open_connections(port, count):
+    loop = asyncio.get_event_loop()
+
+    transports = []
+    for start in range(0, count, CONNECT_BATCH):
+        for transport, _ in await asyncio.gather(
+            *(
+                loop.create_connection(asyncio.Protocol, "127.0.0.1", port)
+                for _ in range(min(CONNECT_BATCH, count - start))
+            )
+        ):
+            # An idle connection has said something at least once.
+            transport.write(PACKET)
+            transports.append(transport)
+
+    return transports
+
+
+async def _close_connections(coordinator, transports):
+    for transport in transports:
+        transport.close()
+    await coordinator.wait(lambda stats: stats["connections"] == 0)
+
+
+async def _benchmark(mode, count, packets):
+    coordinator = Coordinator(mode)
+    try:
+        before = coordinator.query()
+        transports = await _open_connections(coordinator.port, count)
+        idle = await coordinator.wait(
+            lambda stats: stats["connections"] == count and stats["handled"] == before["handled"] + count
+        )
+
+        # Every connection sends a burst of packets at the same time.
+        start = time.perf_counter()
+        for transport in transports:
+            transport.write(PACKET * packets)
+        busy = await coordinator.wait(lambda stats: stats["handled"] == idle["handled"] + count * packets)
+        duration = time.perf_counter() - start
+        await _close_connections(coordinator, transports)
+
+        # tracemalloc slows down everything, and takes memory of its own;
+        # only trace while the connections are opened again.
+        traced = coordinator.query("trace")
+        transports = await _open_connections(coordinator.port, count)
+        traced_idle = await coordinator.wait(
+            lambda stats: stats["connections"] == count and stats["handled"] == traced["handled"] + count
+        )
+        await _close_connections(coordinator, transports)
+    finally:
+        coordinator.stop()
+
+    cpu_time = busy["cpu_time"] - idle["cpu_time"]
+    return {
+        "connections": count,
+        "rss_per_connection": (idle["rss"] - before["rss"]) / count,
+        "traced_per_connection": (traced_idle["traced"] - traced["traced"]) / count,
+        "packets_per_sec": count * packets / duration,
+        "packets_per_cpu_sec": count * packets / cpu_time if cpu_time else 0,
+    }
+
+
+@click.command()
+@click.option("--connections", help="Amount of connections to open.", default=10000, show_default=True)
+@click.option("--packets", help="Packets every connection sends in its burst.", default=20, show_default=True)
+@click.option("--mode", help="Only benchmark this way of dispatching packets.", type=click.Choice(list(MODES)))
+@click.option("--save", help="Save the results to this JSON file.", type=click.Path(dir_okay=False))
+def main(connections, packets, mode, save):
+    _raise_open_files_limit()
+
+    results = {}
+    for name in [mode] if mode else MODES:
+        result = asyncio.run(_benchmark(name, connections, packets))
+        results[name] = result
+
+        print(
+            f"{name:6}: {result['rss_per_connection']:.0f} bytes RSS and "
+            f"{result['traced_per_connection']:.0f} bytes traced per idle connection, "
+            f"{result['packets_per_cpu_sec']:.0f} packets per CPU-second "
+            f"({result['packets_per_sec']:.0f} packets/sec) with {result['connections']} connections"
+        )
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Realistic packets for the benchmarks and the fuzzer.
+
+Packets received by the Game Coordinator are built with the same schema the
+coordinator decodes them with, so they follow any change to the protocol.
+"""
+
+import types
+
+from game_coordinator.openttd import receive
+from game_coordinator.openttd.protocol.enums import (
+    ConnectionType,
+    NetworkCoordinatorErrorType,
+    PacketTCPCoordinatorType,
+    PacketTCPStunType,
+    PacketTCPTurnType,
+    ServerGameType,
+)
+from game_coordinator.openttd.protocol.packets import (
+    COORDINATOR_PACKETS,
+    STUN_PACKETS,
+    TURN_PACKETS,
+)
+from game_coordinator.openttd.protocol.schema import create_encoder
+from game_coordinator.openttd.send import (
+    OpenTTDProtocolCoordinatorSend,
+    OpenTTDProtocolTurnSend,
+)
+
+JOIN_KEY = "aBcDeFg"
+TOKEN = "C" + "0123456789abcdef" * 2
+
+
+def game_info(newgrfs=10, name="My OpenTTD server"):
+    return {
+        "game_info_version": 5,
+        "join_key": JOIN_KEY,
+        "newgrfs": [(0x4E4D0000 + i, bytes(range(i % 16, i % 16 + 16))) for i in range(newgrfs)],
+        "game_date": 750000,
+        "start_date": 720000,
+        "companies_max": 15,
+        "companies_on": 4,
+        "spectators_max": 10,
+        "name": name,
+        "openttd_version": "12.0",
+        "use_password": 0,
+        "clients_max": 25,
+        "clients_on": 7,
+        "spectators_on": 1,
+        "map_width": 1024,
+        "map_height": 512,
+        "map_type": 1,
+        "is_dedicated": 1,
+    }
+
+
+# Amounts of NewGRFs to time CLIENT_UPDATE with; 255 is the most a server can
+# send, which makes it the biggest packet there is.
+NEWGRF_COUNTS = (1, 50, 255)
+
+
+def client_update_arguments(newgrfs):
+    return dict(protocol_version=1, **game_info(newgrfs=newgrfs, name="x" * 80))
+
+
+# Arguments of every packet received, by type.
+COORDINATOR_RECEIVED = {
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_REGISTER: dict(
+        protocol_version=1, game_type=ServerGameType.SERVER_GAME_TYPE_PUBLIC, server_port=3979
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_UPDATE: client_update_arguments(max(NEWGRF_COUNTS)),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_LISTING: dict(protocol_version=1),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECT: dict(protocol_version=1, join_key=JOIN_KEY),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECT_FAILED: dict(
+        protocol_version=1, token=TOKEN, tracking_number=1
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECTED: dict(protocol_version=1, token=TOKEN),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_STUN_RESULT: dict(
+        protocol_version=1, token=TOKEN, family=1, result=1
+    ),
+}
+STUN_RECEIVED = {
+    PacketTCPStunType.PACKET_STUN_CLIENT_STUN: dict(protocol_version=1, token=TOKEN, interface_number=0),
+}
+TURN_RECEIVED = {
+    PacketTCPTurnType.PACKET_TURN_CLIENT_CONNECT: dict(protocol_version=1, token=TOKEN),
+    PacketTCPTurnType.PACKET_TURN_CLIENT_STATS: dict(protocol_version=1, token=TOKEN[1:]),
+}
+
+# Arguments of every packet sent, by the name of its send_PACKET_* method.
+SENT = {
+    "PACKET_COORDINATOR_SERVER_ERROR": (
+        NetworkCoordinatorErrorType.NETWORK_COORDINATOR_ERROR_INVALID_JOIN_KEY,
+        JOIN_KEY,
+    ),
+    "PACKET_COORDINATOR_SERVER_REGISTER_ACK": (JOIN_KEY, ConnectionType.CONNECTION_TYPE_STUN),
+    "PACKET_COORDINATOR_SERVER_CONNECTING": (TOKEN, JOIN_KEY),
+    "PACKET_COORDINATOR_SERVER_CONNECT_FAILED": (TOKEN,),
+    "PACKET_COORDINATOR_SERVER_DIRECT_CONNECT": (TOKEN, 1, "2001:db8::1", 3979),
+    "PACKET_COORDINATOR_SERVER_STUN_REQUEST": (TOKEN,),
+    "PACKET_COORDINATOR_SERVER_STUN_CONNECT": (TOKEN, 2, 0, "192.0.2.1", 51234),
+    "PACKET_COORDINATOR_SERVER_TURN_CONNECT": (TOKEN, 3, "turn.example.com", 3974),
+    "PACKET_TURN_SERVER_CONNECTED": ("192.0.2.1", 51234),
+    "PACKET_TURN_SERVER_STATS": (120, 2500000),
+}
+
+
+def received_packets():
+    """All packets the Game Coordinator receives, as (protocol class, type, bytes)."""
+
+    result = []
+    for cls, packets, received in (
+        (receive.OpenTTDProtocolCoordinatorReceive, COORDINATOR_PACKETS, COORDINATOR_RECEIVED),
+        (receive.OpenTTDProtocolStunReceive, STUN_PACKETS, STUN_RECEIVED),
+        (receive.OpenTTDProtocolTurnReceive, TURN_PACKETS, TURN_RECEIVED),
+    ):
+        for type, arguments in received.items():
+            result.append((cls, type, create_encoder(packets[type], type)(**arguments)))
+    return result
+
+
+def client_update(newgrfs):
+    """A CLIENT_UPDATE packet with "newgrfs" NewGRFs."""
+
+    type = PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_UPDATE
+    return create_encoder(COORDINATOR_PACKETS[type], type)(**client_update_arguments(newgrfs))
+
+
+def servers(count):
+    """A server list as the coordinator has it, with "count" public servers."""
+
+    result = {}
+    for i in range(count):
+        join_key = f"k{i:06d}"
+        info = game_info(newgrfs=i % 40, name=f"Server {i}")
+        info["join_key"] = join_key
+        result[join_key] = types.SimpleNamespace(
+            game_type=ServerGameType.SERVER_GAME_TYPE_PUBLIC, info=info, listing_entry=None
+        )
+    return result
+
+
+class Callback:
+    """Application that accepts every packet, and does nothing with it."""
+
+    def __getattr__(self, name):
+        if not name.startswith("receive_PACKET_"):
+            raise AttributeError(name)
+        return _ignore
+
+
+def _ignore(*args, **kwargs):
+    pass
+
+
+def create_receiver(cls):
+    receiver = cls()
+    receiver._dispatch_table = receiver.get_dispatch_table(Callback())
+    return receiver
+
+
+class Sender(OpenTTDProtocolCoordinatorSend, OpenTTDProtocolTurnSend):
+    """Protocol that keeps the last packet sent, instead of sending it."""
+
+    def __init__(self):
+        self.packet = None
+
+    async def send_packet(self, data):
+        self.packet = data
+
+    def send_packet_nowait(self, data):
+        self.packet = data
+
+
+def run(coroutine):
+    """Run a coroutine that never actually waits; this keeps the event loop out of the measurements."""
+
+    try:
+        coroutine.send(None)
+    except StopIteration:
+        pass
+    else:
+        raise RuntimeError("coroutine unexpectedly waited")
+
+
+# The source of every received packet; it is registered as the server of
+# the CLIENT_UPDATE packet.
+SOURCE = types.SimpleNamespace(join_key=JOIN_KEY)
@@ -0,0 +1,141 @@
+"""
+Fuzzer for the OpenTTD protocol decoders.
+
+Feeds mutated versions of valid packets, random bytes, and huge strings to
+the framing and every decoder. Every input has to be either accepted or
+rejected with a PacketInvalid exception, within a time budget. The exit
+code is non-zero if any input fails:
+
+    python -m benchmarks.fuzz --iterations 100000 --seed 1
+"""
+
+import click
+import random
+import struct
+import sys
+import time
+
+from game_coordinator.openttd.protocol.exceptions import PacketInvalid
+from game_coordinator.openttd.protocol.write import SEND_MTU
+
+from . import corpus
+
+
+def _random_bytes(rnd, count):
+    return bytes(rnd.randrange(256) for _ in range(count))
+
+
+def _mutate(rnd, packet):
+    data = bytearray(packet)
+
+    for _ in range(rnd.randint(1, 4)):
+        mutation = rnd.randrange(6)
+        if mutation == 0 and data:
+            # Flip a byte.
+            data[rnd.randrange(len(data))] = rnd.randrange(256)
+        elif mutation == 1 and data:
+            # Truncate.
+            del data[rnd.randrange(len(data)) :]
+        elif mutation == 2:
+            # Insert random bytes.
+            offset = rnd.randrange(len(data) + 1)
+            data[offset:offset] = _random_bytes(rnd, rnd.randint(1, 16))
+        elif mutation == 3 and data:
+            # Remove all string terminators.
+            data = data.replace(b"\x00", b"a")
+        elif mutation == 4:
+            # Invalid UTF-8.
+            offset = rnd.randrange(len(data) + 1)
+            data[offset:offset] = b"\xff\xfe"
+        else:
+            # Change the type.
+            if len(data) > 2:
+                data[2] = rnd.randrange(256)
+
+    # Mostly keep the length field right, so the decoders get to see it.
+    if len(data) >= 2 and rnd.random() < 0.8:
+        struct.pack_into("<H", data, 0, len(data) & 0xFFFF)
+    return bytes(data)
+
+
+def _huge_strings(packets):
+    # Long unterminated strings are the most expensive input for the string
+    # reader; fill the biggest packet there is with them.
+    for cls, _, packet in packets:
+        data = bytearray(packet[:3] + b"\x01" + b"a" * (SEND_MTU - 4))
+        struct.pack_into("<H", data, 0, len(data))
+        yield cls, bytes(data)
+
+
+def _inputs(rnd, packets, iterations):
+    yield from _huge_strings(packets)
+
+    for _ in range(iterations):
+        cls, _, packet = rnd.choice(packets)
+        if rnd.random() < 0.1:
+            # Completely random.
+            packet = _random_bytes(rnd, rnd.randint(0, 64))
+        yield cls, _mutate(rnd, packet)
+
+
+def check(receiver, data):
+    """Feed "data" to both the framing and the decoder; only PacketInvalid may escape."""
+
+    def dispatch(data, start, end):
+        receiver.receive_packet(corpus.SOURCE, data, start, end)
+
+    for func in (
+        lambda: receiver.receive_data(dispatch, bytearray(data), 0, len(data)),
+        lambda: receiver.receive_packet(corpus.SOURCE, data),
+    ):
+        try:
+            func()
+        except PacketInvalid:
+            pass
+
+
+def _time(receiver, data):
+    start = time.perf_counter()
+    check(receiver, data)
+    return (time.perf_counter() - start) * 1000
+
+
+@click.command()
+@click.option("--iterations", help="Amount of mutated inputs to try.", default=100000, show_default=True)
+@click.option("--seed", help="Seed of the random generator; random if not given.", type=int)
+@click.option("--budget", help="Milliseconds every input may take.", default=5.0, show_default=True)
+def main(iterations, seed, budget):
+    if seed is None:
+        seed = random.randrange(2**32)
+    print(f"Seed: {seed}")
+
+    rnd = random.Random(seed)
+    packets = corpus.received_packets()
+    receivers = {cls: corpus.create_receiver(cls) for cls, _, _ in packets}
+
+    failures = 0
+    slowest = 0
+    for cls, data in _inputs(rnd, packets, iterations):
+        try:
+            duration = _time(receivers[cls], data)
+            # The process can be scheduled out at any time; only inputs that
+            # are slow every time are a problem.
+            if duration > budget:
+                duration = min(duration, *(_time(receivers[cls], data) for _ in range(2)))
+        except Exception as e:
+            failures += 1
+            print(f"{cls.__name__}: {data!r} raised {e!r}")
+            continue
+
+        slowest = max(slowest, duration)
+        if duration > budget:
+            failures += 1
+            print(f"{cls.__name__}: input of {len(data)} bytes took {duration:.2f} ms")
+
+    print(f"Tried {iterations} inputs; slowest took {slowest:.2f} ms; {failures} failures")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""CPU time and memory of a process, read from /proc; Linux only."""
+
+import os
+
+
+def get_cpu_time(pid="self"):
+    """User plus system CPU time of the process, in seconds."""
+
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def get_rss(pid="self"):
+    """Resident memory of the process, in bytes."""
+
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
@@ -0,0 +1,271 @@
+"""
+Benchmark of the TURN relay.
+
+Starts the TURN server in a separate process on loopback, and connects
+pairs of simulated OpenTTD clients and servers to it. Every pair does the
+TURN_CLIENT_CONNECT handshake, after which both sides send game-like
+traffic: small packets at a steady rate, and every now and then the server
+sends a map (a burst of big packets).
+
+Reports the throughput, the latency the relay adds to the small packets,
+the CPU time the TURN server spends per GB relayed, and its memory per
+relay. The added latency is the latency through the relay minus that of
+the same traffic over a direct loopback connection. CPU and memory are
+read from /proc, so this only works on Linux:
+
+    python -m benchmarks.relay --pairs 100 --seconds 10
+
+With --splice it also reports how many relays were handed over to splice().
+Don't expect a gain with the default traffic: it is mostly small packets,
+and every packet costs a wakeup and two system calls either way; with or
+without splice(), that is where the CPU time goes. splice() only saves the
+copies through Python, which matter for bulk transfers; raise --map-chance
+to see that (on loopback, expect around 10% less CPU per GB).
+"""
+
+import asyncio
+import click
+import json
+import multiprocessing
+import random
+import struct
+import time
+
+from game_coordinator.application.helpers.signed_token import create_signed_token
+from game_coordinator.application.turn import Application as TurnApplication
+from game_coordinator.openttd.protocol.enums import PacketTCPTurnType
+from game_coordinator.openttd.protocol.packets import TURN_PACKETS
+from game_coordinator.openttd.protocol.schema import create_encoder
+from game_coordinator.openttd.tcp_turn import OpenTTDProtocolTCPTurn
+
+from .proc import (
+    get_cpu_time,
+    get_rss,
+)
+
+# Game packets: size, type, and the time it was sent.
+_header = struct.Struct("<HBd")
+TYPE_GAME = 10
+TYPE_MAP = 11
+
+# Small packets every side sends per second, and their payload.
+GAME_RATE = 30
+GAME_PAYLOAD = 80
+# Chance per game packet the server starts sending a map, and its size.
+MAP_CHANCE = 1 / 150
+MAP_PACKETS = 750
+MAP_PAYLOAD = 1400
+
+_encode_connect = create_encoder(
+    TURN_PACKETS[PacketTCPTurnType.PACKET_TURN_CLIENT_CONNECT], PacketTCPTurnType.PACKET_TURN_CLIENT_CONNECT
+)
+
+
+def _serve(connection, splice):
+    OpenTTDProtocolTCPTurn.splice = splice
+    application = TurnApplication(None)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(
+        loop.create_server(lambda: OpenTTDProtocolTCPTurn(application), host="127.0.0.1", port=0)
+    )
+
+    def stats():
+        connection.recv()
+        stats = application.get_stats()
+        connection.send({"relays": stats["relays"], "spliced_relays": stats["spliced_relays"]})
+
+    loop.add_reader(connection.fileno(), stats)
+    connection.send(server.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+
+class Stats:
+    def __init__(self):
+        self.bytes = 0
+        self.latencies = []
+
+    def get_percentile(self, percentile):
+        return self.latencies[min(int(len(self.latencies) * percentile), len(self.latencies) - 1)]
+
+
+async def _read_packet(reader):
+    length = struct.unpack("<H", await reader.readexactly(2))[0]
+    return await reader.readexactly(length - 2)
+
+
+async def _send(writer, end, map_chance):
+    await asyncio.sleep(random.random() / GAME_RATE)
+
+    while time.perf_counter() < end:
+        writer.write(_header.pack(_header.size + GAME_PAYLOAD, TYPE_GAME, time.perf_counter()) + bytes(GAME_PAYLOAD))
+        if map_chance and random.random() < map_chance:
+            for _ in range(MAP_PACKETS):
+                writer.write(_header.pack(_header.size + MAP_PAYLOAD, TYPE_MAP, 0) + bytes(MAP_PAYLOAD))
+
+        await writer.drain()
+        await asyncio.sleep(1 / GAME_RATE)
+
+
+async def _receive(reader, end, stats):
+    while True:
+        try:
+            header = await asyncio.wait_for(reader.readexactly(_header.size), max(end + 1 - time.perf_counter(), 0.01))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return
+
+        size, type, sent = _header.unpack(header)
+        await reader.readexactly(size - _header.size)
+
+        stats.bytes += size
+        if type == TYPE_GAME and time.perf_counter() < end:
+            stats.latencies.append(time.perf_counter() - sent)
+
+
+async def _connect_relay(port):
+    token = create_signed_token()
+
+    server = await asyncio.open_connection("127.0.0.1", port)
+    client = await asyncio.open_connection("127.0.0.1", port)
+    server[1].write(_encode_connect(protocol_version=1, token=f"S{token}"))
+    client[1].write(_encode_connect(protocol_version=1, token=f"C{token}"))
+
+    # Both sides are told the other side connected.
+    for reader, _ in (server, client):
+        await _read_packet(reader)
+
+    return server, client
+
+
+async def _connect_direct(listener_port, accepted):
+    client = await asyncio.open_connection("127.0.0.1", listener_port)
+    server = await accepted.get()
+    return server, client
+
+
+async def _run_traffic(pairs, seconds, map_chance):
+    stats = Stats()
+    end = time.perf_counter() + seconds
+
+    tasks = []
+    for server, client in pairs:
+        tasks.append(_send(server[1], end, map_chance))
+        tasks.append(_send(client[1], end, 0))
+        tasks.append(_receive(server[0], end, stats))
+        tasks.append(_receive(client[0], end, stats))
+
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - start
+
+    stats.latencies.sort()
+    return stats, duration
+
+
+def _close(pairs):
+    for server, client in pairs:
+        server[1].close()
+        client[1].close()
+
+
+async def _benchmark_direct(count, seconds, map_chance):
+    accepted = asyncio.Queue()
+    listener = await asyncio.start_server(
+        lambda reader, writer: accepted.put_nowait((reader, writer)), host="127.0.0.1", port=0
+    )
+    port = listener.sockets[0].getsockname()[1]
+
+    pairs = [await _connect_direct(port, accepted) for _ in range(count)]
+    stats, _ = await _run_traffic(pairs, seconds, map_chance)
+    _close(pairs)
+
+    listener.close()
+    return stats
+
+
+async def _benchmark_relay(count, seconds, map_chance, pid, port, connection):
+    rss_idle = get_rss(pid)
+    pairs = [await _connect_relay(port) for _ in range(count)]
+    rss_relays = get_rss(pid)
+
+    cpu_start = get_cpu_time(pid)
+    stats, duration = await _run_traffic(pairs, seconds, map_chance)
+    cpu_time = get_cpu_time(pid) - cpu_start
+
+    # Ask the TURN server which relays it handed over to splice().
+    connection.send("stats")
+    server_stats = connection.recv()
+    _close(pairs)
+
+    return {
+        "pairs": count,
+        "bytes_per_sec": stats.bytes / duration,
+        "cpu_seconds_per_gb": cpu_time / (stats.bytes / 1e9) if stats.bytes else 0,
+        "rss_per_relay": (rss_relays - rss_idle) / count,
+        "rss": rss_relays,
+        "spliced_relays": server_stats["spliced_relays"],
+    }, stats
+
+
+@click.command()
+@click.option("--pairs", help="Amount of relays to run at the same time.", default=100, show_default=True)
+@click.option("--seconds", help="Seconds to send traffic for.", default=10, show_default=True)
+@click.option("--splice", help="Let the TURN server relay with splice().", is_flag=True)
+@click.option(
+    "--map-chance",
+    help="Chance per small packet that the server starts sending a map.",
+    default=MAP_CHANCE,
+    show_default=True,
+    type=click.FloatRange(0, 1),
+)
+@click.option(
+    "--seed", help="Seed of the random traffic; both runs send the same traffic.", default=1, show_default=True
+)
+@click.option("--save", help="Save the results to this JSON file.", type=click.Path(dir_okay=False))
+def main(pairs, seconds, splice, map_chance, seed, save):
+    # Fork, so the TURN server shares the secret the tokens are signed with.
+    context = multiprocessing.get_context("fork")
+    connection, child_connection = context.Pipe()
+    process = context.Process(target=_serve, args=(child_connection, splice), daemon=True)
+    process.start()
+    port = connection.recv()
+
+    try:
+        random.seed(seed)
+        direct = asyncio.run(_benchmark_direct(pairs, seconds, map_chance))
+        random.seed(seed)
+        result, relay = asyncio.run(_benchmark_relay(pairs, seconds, map_chance, process.pid, port, connection))
+    finally:
+        process.terminate()
+        process.join()
+
+    for percentile in (0.5, 0.9, 0.99):
+        result[f"latency_p{int(percentile * 100)}"] = relay.get_percentile(percentile)
+        result[f"added_latency_p{int(percentile * 100)}"] = relay.get_percentile(percentile) - direct.get_percentile(
+            percentile
+        )
+
+    print(
+        f"{result['pairs']} relays for {seconds} seconds: {result['bytes_per_sec'] / 1e6:.1f} MB/s, "
+        f"{result['cpu_seconds_per_gb']:.1f} CPU-seconds per GB relayed, "
+        f"{result['rss_per_relay'] / 1024:.0f} KiB RSS per relay ({result['rss'] / 2**20:.0f} MiB in total)"
+    )
+    if splice:
+        print(f"Relays forwarded with splice(): {result['spliced_relays']} of {result['pairs']}")
+    print(
+        "Latency through the relay (ms): "
+        + ", ".join(f"{name[8:]} {result[name] * 1000:.2f}" for name in result if name.startswith("latency_"))
+    )
+    print(
+        "Added by the relay (ms): "
+        + ", ".join(f"{name[14:]} {result[name] * 1000:.2f}" for name in result if name.startswith("added_latency_"))
+    )
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
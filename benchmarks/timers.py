@@ -0,0 +1,200 @@
+"""
+Benchmark of the timer wheel, with many timeouts pending at once.
+
+Schedules --timers timeouts, half of them 1 second away and half of them 4
+seconds away, like the timeouts of connection attempts and relays. Half of
+them are cancelled again, as most timeouts are; the other half fire. For
+every step, the time it takes per timeout is reported; for firing this is
+CPU time, as the wall time is mostly spent waiting. It also reports how
+late timeouts fire, and the memory every pending timeout takes. Lateness
+is counted from the deadline asked for; with a task per timeout, this
+includes the time it takes before the event loop gets to start the task.
+
+The timer wheel is compared with how timeouts were done before it: a task
+per timeout, either waiting with asyncio.wait_for() or sleeping with
+asyncio.sleep(). A plain loop.call_later() is included as reference:
+
+    python -m benchmarks.timers --timers 100000
+"""
+
+import asyncio
+import click
+import json
+import time
+import tracemalloc
+
+from game_coordinator.openttd.timer_wheel import TimerWheel
+
+# Seconds the timeouts are away; every other timeout uses the next one.
+DELAYS = (1, 4)
+
+
+class Wheel:
+    def __init__(self):
+        self._wheel = TimerWheel()
+
+    def call_later(self, delay, callback, *args):
+        return self._wheel.call_later(delay, callback, *args)
+
+    def cancel(self, timer):
+        timer.cancel()
+
+
+class CallLater:
+    def call_later(self, delay, callback, *args):
+        return asyncio.get_event_loop().call_later(delay, callback, *args)
+
+    def cancel(self, handle):
+        handle.cancel()
+
+
+async def _wait_for(future, delay, callback, args):
+    try:
+        await asyncio.wait_for(future, delay)
+    except asyncio.TimeoutError:
+        callback(*args)
+
+
+class WaitForTask:
+    """A task per timeout, waiting for a future with asyncio.wait_for(); resolving the future cancels the timeout."""
+
+    def call_later(self, delay, callback, *args):
+        future = asyncio.get_event_loop().create_future()
+        asyncio.create_task(_wait_for(future, delay, callback, args))
+        return future
+
+    def cancel(self, future):
+        future.set_result(None)
+
+
+async def _sleep(delay, callback, args):
+    await asyncio.sleep(delay)
+    callback(*args)
+
+
+class SleepTask:
+    """A task per timeout, sleeping with asyncio.sleep(); cancelling the task cancels the timeout."""
+
+    def call_later(self, delay, callback, *args):
+        return asyncio.create_task(_sleep(delay, callback, args))
+
+    def cancel(self, task):
+        task.cancel()
+
+
+MODES = {
+    "wheel": Wheel,
+    "wait_for": WaitForTask,
+    "sleep": SleepTask,
+    "call_later": CallLater,
+}
+
+
+async def _settle():
+    # Cancelled tasks need a few iterations of the event loop to finish.
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def _schedule(timers, count, callback):
+    loop = asyncio.get_event_loop()
+    handles = []
+    for i in range(count):
+        delay = DELAYS[i % len(DELAYS)]
+        handles.append(timers.call_later(delay, callback, loop.time() + delay))
+    return handles
+
+
+def _cancel(timers, handles):
+    # Cancel half of every deadline: the first two of every four.
+    for i in range(0, len(handles), 4):
+        for handle in handles[i : i + 2]:
+            timers.cancel(handle)
+
+
+async def _benchmark(mode, count):
+    loop = asyncio.get_event_loop()
+    timers = MODES[mode]()
+    late = []
+
+    def fired(deadline):
+        late.append(loop.time() - deadline)
+
+    start = time.perf_counter()
+    handles = _schedule(timers, count, fired)
+    await _settle()
+    insert = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _cancel(timers, handles)
+    await _settle()
+    cancel = time.perf_counter() - start
+
+    expected = count - len(range(0, count, 4)) - len(range(1, count, 4))
+    start = time.process_time()
+    while len(late) < expected:
+        await asyncio.sleep(0.05)
+    fire = time.process_time() - start
+
+    # Nothing that was cancelled may fire.
+    await asyncio.sleep(0.2)
+    if len(late) != expected:
+        raise RuntimeError(f"{len(late)} timeouts fired, instead of {expected}")
+
+    return {
+        "timers": count,
+        "insert_ns": insert / count * 1e9,
+        "cancel_ns": cancel / (count - expected) * 1e9,
+        "fire_cpu_ns": fire / expected * 1e9,
+        "late_avg_ms": sum(late) / len(late) * 1000,
+        "late_max_ms": max(late) * 1000,
+    }
+
+
+async def _measure_memory(mode, count):
+    timers = MODES[mode]()
+
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        handles = _schedule(timers, count, lambda deadline: None)
+        await _settle()
+        pending, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    for handle in handles:
+        timers.cancel(handle)
+    await _settle()
+
+    return (pending - base) / count
+
+
+@click.command()
+@click.option("--timers", help="Amount of timeouts to schedule.", default=100000, show_default=True)
+@click.option("--mode", help="Only benchmark this way of doing timeouts.", type=click.Choice(list(MODES)))
+@click.option("--save", help="Save the results to this JSON file.", type=click.Path(dir_okay=False))
+def main(timers, mode, save):
+    results = {}
+
+    print(
+        f"{'mode':12} {'insert ns':>10} {'cancel ns':>10} {'fire CPU ns':>12} "
+        f"{'late avg ms':>12} {'late max ms':>12} {'bytes':>8}"
+    )
+    for name in [mode] if mode else MODES:
+        result = asyncio.run(_benchmark(name, timers))
+        result["bytes_per_timer"] = asyncio.run(_measure_memory(name, timers))
+        results[name] = result
+
+        print(
+            f"{name:12} {result['insert_ns']:10.0f} {result['cancel_ns']:10.0f} {result['fire_cpu_ns']:12.0f} "
+            f"{result['late_avg_ms']:12.1f} {result['late_max_ms']:12.1f} {result['bytes_per_timer']:8.0f}"
+        )
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmark of the signed tokens TURN servers validate.
+
+Measures how many tokens per second can be signed, validated, and
+rejected; for every way a token can be rejected. Every TURN connection
+validates a token, so validating has to stay well above --min-rate; the
+exit code is non-zero if any validation is slower than that:
+
+    python -m benchmarks.tokens
+"""
+
+import click
+import sys
+
+from game_coordinator.application.helpers import signed_token
+
+from .codec import measure
+
+
+def _create_expired_token():
+    lifetime = signed_token.TOKEN_LIFETIME
+    signed_token.TOKEN_LIFETIME = -1
+    try:
+        return signed_token.create_signed_token()
+    finally:
+        signed_token.TOKEN_LIFETIME = lifetime
+
+
+def get_cases():
+    token = signed_token.create_signed_token()
+
+    # Every token has to be validated as expected, or the timing is of the
+    # wrong path.
+    tokens = {
+        "valid": (token, True),
+        "reject.length": (token[:-2], False),
+        "reject.not-hex": (token[:-1] + "x", False),
+        "reject.whitespace": (token[:-2] + " 0", False),
+        "reject.expired": (_create_expired_token(), False),
+        "reject.signature": (token[:-1] + ("0" if token[-1] != "0" else "1"), False),
+    }
+
+    cases = {"sign": signed_token.create_signed_token}
+    for name, (token, expected) in tokens.items():
+        if signed_token.validate_signed_token(token) is not expected:
+            raise RuntimeError(f"token for {name} is not validated as expected")
+        cases[f"validate.{name}"] = lambda token=token: signed_token.validate_signed_token(token)
+    return cases
+
+
+@click.command()
+@click.option("--repeat", help="Take the best of this many runs.", default=5, show_default=True)
+@click.option("--min-rate", help="Tokens per second every validation has to reach.", default=100000, show_default=True)
+def main(repeat, min_rate):
+    failures = 0
+    print(f"{'case':32} {'ns/op':>10} {'ops/sec':>12}")
+    for name, func in get_cases().items():
+        rate = 1e9 / measure(func, 1, repeat)["ns"]
+
+        line = f"{name:32} {1e9 / rate:10.0f} {rate:12.0f}"
+        if name.startswith("validate.") and rate < min_rate:
+            failures += 1
+            line += "  below --min-rate"
+        print(line)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
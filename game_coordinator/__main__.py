@@ -1,21 +1,40 @@
 import asyncio
 import click
 import logging
+import sys
 
 from openttd_helpers import click_helper
 from openttd_helpers.logging_helper import click_logging
 from openttd_helpers.sentry_helper import click_sentry
 
 from .application.coordinator import Application as CoordinatorApplication
+from .application.helpers.signed_token import click_turn_secret
+from .application.helpers.stun_store import (
+    click_stun_stats_interval,
+    click_stun_wait_timeout,
+)
 from .application.stun import Application as StunApplication
-from .application.turn import Application as TurnApplication
+from .application.turn import (
+    Application as TurnApplication,
+    click_turn_stats_interval,
+)
 from .openttd import (
     tcp_coordinator,
     tcp_stun,
     tcp_turn,
 )
+from .openttd.receive import (
+    PacketStats,
+    click_packet_stats_interval,
+)
 from .openttd.tcp_coordinator import click_coordinator_proxy_protocol
 from .openttd.tcp_stun import click_stun_proxy_protocol
+from .openttd.tcp_turn import (
+    click_turn_relay_memory,
+    click_turn_shaping,
+    click_turn_splice,
+)
+from .openttd.turn_workers import TurnWorkers
 
 log = logging.getLogger(__name__)
 
@@ -35,6 +54,41 @@ async def run_server(application, bind, port, ProtocolClass):
     return server
 
 
+def _parse_turn_servers(ctx, param, value):
+    turn_servers = []
+    for address in value:
+        if address.startswith("["):
+            host, bracket, port = address[1:].partition("]:")
+            if not bracket:
+                raise click.BadParameter(f"'{address}' is not of the form [host]:port")
+        else:
+            host, _, port = address.rpartition(":")
+            if ":" in host:
+                raise click.BadParameter(f"'{address}' is an IPv6 address; use [host]:port")
+        if not host:
+            raise click.BadParameter(f"'{address}' is not of the form host:port")
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            raise click.BadParameter(f"'{address}' has no valid port; use host:port")
+        turn_servers.append((host, int(port)))
+    return turn_servers
+
+
+def run_turn_worker(workers, bind, turn_port):
+    turn_instance = TurnApplication(None, workers)
+
+    loop = asyncio.get_event_loop()
+    turn_server = loop.run_until_complete(run_server(turn_instance, bind, turn_port, tcp_turn.OpenTTDProtocolTCPTurn))
+    workers.start(lambda: tcp_turn.OpenTTDProtocolTCPTurn(turn_instance))
+    PacketStats.start()
+
+    try:
+        loop.run_until_complete(turn_server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+    turn_server.close()
+
+
 @click_helper.command()
 @click_logging  # Should always be on top, as it initializes the logging
 @click_sentry
@@ -44,30 +98,86 @@ async def run_server(application, bind, port, ProtocolClass):
 @click.option("--coordinator-port", help="Port of the Game Coordinator", default=3976, show_default=True)
 @click.option("--stun-port", help="Port of the STUN server", default=3975, show_default=True)
 @click.option("--turn-port", help="Port of the TURN server", default=3974, show_default=True)
+@click.option(
+    "--turn-server",
+    help="TURN server (host:port, or [host]:port for IPv6) to send clients to; can be given multiple times. "
+    "If not given, the TURN server of this process is used as coordinator.openttd.org:3974.",
+    multiple=True,
+    callback=_parse_turn_servers,
+)
+@click.option(
+    "--turn-workers",
+    help="Run the TURN server in this many separate processes (0 to run it in this process).",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
 @click_coordinator_proxy_protocol
 @click_stun_proxy_protocol
-def main(bind, coordinator_port, stun_port, turn_port):
+@click_stun_wait_timeout
+@click_stun_stats_interval
+@click_turn_splice
+@click_turn_relay_memory
+@click_turn_shaping
+@click_turn_stats_interval
+@click_packet_stats_interval
+@click_turn_secret
+def main(bind, coordinator_port, stun_port, turn_port, turn_server, turn_workers):
+    # Fork the TURN workers before anything else is started; after this, the
+    # workers only run the TURN server.
+    workers = None
+    if turn_workers:
+        workers = TurnWorkers(turn_workers)
+        if workers.fork() is not None:
+            run_turn_worker(workers, bind, turn_port)
+            return
+
     app_instance = CoordinatorApplication()
     stun_instance = StunApplication(app_instance)
-    turn_instance = TurnApplication(app_instance)
+    turn_instance = None if workers else TurnApplication(app_instance)
+
+    if turn_server:
+        for host, port in turn_server:
+            app_instance.turn_pool.add(host, port)
+    elif workers:
+        # The workers listen on the same address as the coordinator; ask
+        # them for their load there.
+        app_instance.turn_pool.add("coordinator.openttd.org", 3974, check_address=(bind[0], turn_port))
+    else:
+        app_instance.turn_pool.add("coordinator.openttd.org", 3974, load=turn_instance.get_load)
 
     loop = asyncio.get_event_loop()
     server = loop.run_until_complete(
         run_server(app_instance, bind, coordinator_port, tcp_coordinator.OpenTTDProtocolTCPCoordinator)
     )
     stun_server = loop.run_until_complete(run_server(stun_instance, bind, stun_port, tcp_stun.OpenTTDProtocolTCPStun))
-    turn_server = loop.run_until_complete(run_server(turn_instance, bind, turn_port, tcp_turn.OpenTTDProtocolTCPTurn))
+    if workers:
+        # Without all its workers, part of the relays can't be made; stop,
+        # so whatever supervises us can start us again.
+        workers.watch(server.close)
+    if turn_instance:
+        turn_server = loop.run_until_complete(
+            run_server(turn_instance, bind, turn_port, tcp_turn.OpenTTDProtocolTCPTurn)
+        )
+
+    PacketStats.start()
 
     try:
         loop.run_until_complete(server.serve_forever())
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         pass
 
     log.info("Shutting down game_coordinator ...")
-    turn_server.close()
+    if turn_instance:
+        turn_server.close()
+    if workers:
+        workers.stop()
     stun_server.close()
     server.close()
 
+    if workers and workers.failed:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main(auto_envvar_prefix="GAME_COORDINATOR")
@@ -1,15 +1,20 @@
 import logging
 import secrets
-
-from collections import defaultdict
+import time
 
 from .helpers.encode import human_encode
 from .helpers.server import Server
+from .helpers.signed_token import create_signed_token
+from .helpers.stun_store import StunStore
 from .helpers.token_connect import TokenConnect
+from .helpers.turn_pool import TurnPool
 from ..openttd.protocol.enums import NetworkCoordinatorErrorType
 
 log = logging.getLogger(__name__)
 
+# Minimum amount of seconds between two rebuilds of the server listing.
+LISTING_SNAPSHOT_INTERVAL = 1
+
 
 class Application:
     def __init__(self):
@@ -17,9 +22,21 @@ class Application:
 
         self._servers = {}
         self._tokens = {}
-
-        self.storage_stun = defaultdict(lambda: {})
+        # Tokens in flight, per join-key of the server and per client
+        # source; this makes cleaning up on disconnect cheap.
+        self._server_tokens = {}
+        self._source_tokens = {}
+
+        # Every change to the listed servers increases the generation; the
+        # snapshot of the listing is only rebuilt if it is outdated.
+        self._servers_generation = 0
+        self._listing = None
+        self._listing_generation = None
+        self._listing_created = 0
+
+        self.stun_store = StunStore(self._tokens)
         self.storage_turn = {}
+        self.turn_pool = TurnPool()
 
     def create_server(self, proc):
         while True:
@@ -32,33 +49,54 @@ class Application:
 
     def create_token(self, proc):
         while True:
-            token = secrets.token_hex(16)
+            token = create_signed_token()
             if token not in self._tokens:
                 break
 
-        self._tokens[token] = proc(token)
-        return self._tokens[token]
+        token = proc(token)
+        self._tokens[token.token] = token
+
+        self._server_tokens.setdefault(token._server.join_key, set()).add(token)
+        client_source = getattr(token, "_client_source", None)
+        if client_source is not None:
+            self._source_tokens.setdefault(client_source, set()).add(token)
+
+        return token
 
     def delete_token(self, token):
-        del self._tokens[token]
-        if token in self.storage_stun:
-            del self.storage_stun[token]
+        token_object = self._tokens.pop(token, None)
+        if token_object is None:
+            return
+
+        self._unindex_token(self._server_tokens, token_object._server.join_key, token_object)
+        client_source = getattr(token_object, "_client_source", None)
+        if client_source is not None:
+            self._unindex_token(self._source_tokens, client_source, token_object)
+
+        self.stun_store.delete_token(token)
         if token in self.storage_turn:
             del self.storage_turn[token]
 
+    def _unindex_token(self, index, key, token):
+        tokens = index[key]
+        tokens.discard(token)
+        if not tokens:
+            del index[key]
+
     def disconnect(self, source):
         join_key = getattr(source, "join_key", None)
 
-        if join_key:
-            for token in list(self._tokens.values()):
-                if token._server == self._servers[join_key]:
-                    token.disconnect()
-                    del self._tokens[token.token]
+        # Stop all connection attempts of this server, or of this client.
+        for token in self._server_tokens.get(join_key, set()) | self._source_tokens.get(source, set()):
+            token.disconnect()
+            self.delete_token(token.token)
 
+        if join_key:
             self._servers[join_key].disconnect()
             del self._servers[join_key]
+            self._servers_generation += 1
 
-    async def receive_PACKET_COORDINATOR_CLIENT_REGISTER(self, source, protocol_version, game_type, server_port):
+    def receive_PACKET_COORDINATOR_CLIENT_REGISTER(self, source, protocol_version, game_type, server_port):
         # Reuse the join-key if possible; this means they survive restarts etc.
         if hasattr(source, "join_key"):
             server = self._servers[source.join_key]
@@ -66,54 +104,69 @@ class Application:
             server = self.create_server(lambda join_key: Server(join_key, self, source, game_type, server_port))
             source.join_key = server.join_key
 
-        await server.detect_connection()
+        server.detect_connection()
 
-    async def receive_PACKET_COORDINATOR_CLIENT_UPDATE(self, source, protocol_version, join_key, **info):
+    def receive_PACKET_COORDINATOR_CLIENT_UPDATE(self, source, protocol_version, join_key, **info):
         if join_key not in self._servers:
             source.protocol.transport.close()
 
         self._servers[join_key].update(info)
+        self._servers_generation += 1
+
+    def _get_listing(self, source):
+        # All clients asking for the listing in a short window share the
+        # same snapshot; this both keeps the cost of a burst of requests
+        # constant, and makes sure every client sees a consistent listing,
+        # even if servers change while it is being sent.
+        if self._listing_generation != self._servers_generation:
+            now = time.monotonic()
+            if self._listing is None or now - self._listing_created >= LISTING_SNAPSHOT_INTERVAL:
+                self._listing = source.protocol.encode_server_listing(self._servers)
+                self._listing_generation = self._servers_generation
+                self._listing_created = now
+
+        return self._listing
 
     async def receive_PACKET_COORDINATOR_CLIENT_LISTING(self, source, protocol_version):
-        await source.protocol.send_PACKET_COORDINATOR_SERVER_LISTING(self._servers)
+        await source.protocol.send_PACKET_COORDINATOR_SERVER_LISTING(self._get_listing(source))
 
-    async def receive_PACKET_COORDINATOR_CLIENT_CONNECT(self, source, protocol_version, join_key):
+    def receive_PACKET_COORDINATOR_CLIENT_CONNECT(self, source, protocol_version, join_key):
         server = self._servers.get(join_key)
         if server is None:
-            await source.protocol.send_PACKET_COORDINATOR_SERVER_ERROR(
+            source.protocol.send_PACKET_COORDINATOR_SERVER_ERROR(
                 NetworkCoordinatorErrorType.NETWORK_COORDINATOR_ERROR_INVALID_JOIN_KEY, join_key
             )
             source.protocol.transport.close()
             return
 
         token = self.create_token(lambda token: TokenConnect(token, server, source))
-        await source.protocol.send_PACKET_COORDINATOR_SERVER_CONNECTING(f"C{token.token}", join_key)
+        source.protocol.send_PACKET_COORDINATOR_SERVER_CONNECTING(f"C{token.token}", join_key)
 
-        await token.connect()
+        token.connect()
 
-    async def receive_PACKET_COORDINATOR_CLIENT_CONNECT_FAILED(self, source, protocol_version, token, tracking_number):
+    def receive_PACKET_COORDINATOR_CLIENT_CONNECT_FAILED(self, source, protocol_version, token, tracking_number):
         prefix = token[0]
         token = self._tokens.get(token[1:])
         if token is None:
             # Don't close connection, as this might just be a delayed failure
             return
 
-        await token.connect_failed(prefix, tracking_number)
+        token.connect_failed(prefix, tracking_number)
 
-    async def receive_PACKET_COORDINATOR_CLIENT_CONNECTED(self, source, protocol_version, token):
+    def receive_PACKET_COORDINATOR_CLIENT_CONNECTED(self, source, protocol_version, token):
         token = self._tokens.get(token[1:])
         if token is None:
             source.protocol.transport.close()
             return
 
-        await token.connected()
+        token.connected()
         self.delete_token(token.token)
 
-    async def receive_PACKET_COORDINATOR_CLIENT_STUN_RESULT(self, source, protocol_version, token, family, result):
+    def receive_PACKET_COORDINATOR_CLIENT_STUN_RESULT(self, source, protocol_version, token, family, result):
         prefix = token[0]
         token = self._tokens.get(token[1:])
         if token is None:
             source.protocol.transport.close()
             return
 
-        await token.stun_result(prefix, family, result)
+        token.stun_result(prefix, family, result)
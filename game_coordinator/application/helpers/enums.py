@@ -12,3 +12,10 @@ class Family(enum.Enum):
     UNKNOWN = "unknown"
     IPv4 = "IPv4"
     IPv6 = "IPv6"
+
+
+class ConnectState(enum.Enum):
+    IDLE = "idle"
+    WAITING = "waiting"
+    TRYING = "trying"
+    DONE = "done"
@@ -1,19 +1,24 @@
-import asyncio
 import logging
 
 from .enums import Family
 from .token_verify import TokenVerify
 
 from ...openttd.protocol.enums import ConnectionType
+from ...openttd.protocol.exceptions import SocketClosed
+from ...openttd.timer_wheel import timer_wheel
 
 log = logging.getLogger(__name__)
 
+# Seconds the server has to report its STUN results, before detection ends.
+DETECTION_TIMEOUT = 4
+
 
 class Server:
     def __init__(self, join_key, application, source, game_type, server_port):
         self._application = application
         self._source = source
-        self._task = None
+        self._timer = None
+        self._detection_token = None
 
         self.connection_type = {
             Family.IPv4: ConnectionType.CONNECTION_TYPE_ISOLATED,
@@ -30,39 +35,69 @@ class Server:
         self.game_type = game_type
         self.info = {}
 
+        # Encoded entry of this server in the server listing; created on
+        # demand by the sender, and invalidated on every update.
+        self.listing_entry = None
+
     def disconnect(self):
-        if self._task:
-            self._task.cancel()
+        if self._timer:
+            self._timer.cancel()
 
     def update(self, info):
         if info["newgrfs"] is None:
             info["newgrfs"] = self.info["newgrfs"]
         self.info = info
+        self.listing_entry = None
 
-    async def detect_connection(self):
-        self._task = asyncio.create_task(self._start_detection())
-
-    async def _start_detection(self):
-        try:
-            await self._real_start_detection()
-        except asyncio.CancelledError:
-            pass
+    def detect_connection(self):
+        # Registering again restarts the detection.
+        self._stop_detection()
 
-    async def _real_start_detection(self):
         token = self._application.create_token(lambda token: TokenVerify(token, self))
-        self._detection_done = asyncio.Event()
+        self._detection_token = token
 
-        await self._source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_REQUEST(f"V{token.token}")
+        self._source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_REQUEST(f"V{token.token}")
+        self._timer = timer_wheel.call_later(DETECTION_TIMEOUT, self._detection_timeout)
 
-        try:
-            await asyncio.wait_for(self._detection_done.wait(), 4)
-        except asyncio.TimeoutError:
-            pass
+    def detection_done(self, token):
+        # Only the detection in progress; not one restarted since.
+        if self._detection_token is token:
+            self._finish_detection()
 
-        # Make sure the server frees the resources assigned to this.
-        await self._source.protocol.send_PACKET_COORDINATOR_SERVER_CONNECT_FAILED(f"V{token.token}")
+    def _detection_timeout(self):
+        self._timer = None
+        self._finish_detection()
+
+    def _stop_detection(self):
+        token = self._detection_token
+        if token is None:
+            return False
+
+        self._detection_token = None
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        token.disconnect()
         self._application.delete_token(token.token)
 
+        # Make sure the server frees the resources assigned to this.
+        self._source.protocol.send_PACKET_COORDINATOR_SERVER_CONNECT_FAILED(f"V{token.token}")
+        return True
+
+    def _finish_detection(self):
+        # Detection finishes from timers and from other connections; if the
+        # server is gone, close its connection here, like its own packet
+        # handlers would.
+        try:
+            self._send_detection_result()
+        except SocketClosed:
+            self._source.protocol.transport.abort()
+
+    def _send_detection_result(self):
+        if not self._stop_detection():
+            return
+
         log.info(
             f"Happy server {self.join_key}: "
             + " ".join(
@@ -81,8 +116,4 @@ class Server:
         else:
             ct = ConnectionType.CONNECTION_TYPE_ISOLATED
 
-        await self._source.protocol.send_PACKET_COORDINATOR_SERVER_REGISTER_ACK(
-            join_key=self.join_key, connection_type=ct
-        )
-
-        self._task = None
+        self._source.protocol.send_PACKET_COORDINATOR_SERVER_REGISTER_ACK(join_key=self.join_key, connection_type=ct)
@@ -0,0 +1,70 @@
+import click
+import hmac
+import logging
+import secrets
+import struct
+import time
+
+from openttd_helpers import click_helper
+
+log = logging.getLogger(__name__)
+
+# Seconds a token can be used to start a relay with.
+TOKEN_LIFETIME = 120
+
+# A token is the hex of: expiry (unix timestamp), a random nonce, and the
+# truncated HMAC of both. This keeps it the same length as a random token
+# of 16 bytes, as clients expect.
+_expire = struct.Struct(">I")
+_NONCE_SIZE = 4
+_SIGNATURE_SIZE = 8
+_PAYLOAD_SIZE = _expire.size + _NONCE_SIZE
+_TOKEN_LENGTH = (_PAYLOAD_SIZE + _SIGNATURE_SIZE) * 2
+
+# Unless configured, tokens can only be validated by this process (and
+# processes forked from it).
+_secret = secrets.token_bytes(32)
+
+
+def _sign(payload):
+    return hmac.digest(_secret, payload, "sha256")[:_SIGNATURE_SIZE]
+
+
+def create_signed_token():
+    payload = _expire.pack(int(time.time()) + TOKEN_LIFETIME) + secrets.token_bytes(_NONCE_SIZE)
+    return (payload + _sign(payload)).hex()
+
+
+def validate_signed_token(token):
+    """Check a token is created by create_signed_token() with the same secret, and hasn't expired."""
+
+    if len(token) != _TOKEN_LENGTH:
+        return False
+
+    try:
+        data = bytes.fromhex(token)
+    except ValueError:
+        return False
+
+    # fromhex() skips whitespace, so the length has to be checked again.
+    if len(data) != _PAYLOAD_SIZE + _SIGNATURE_SIZE:
+        return False
+
+    if _expire.unpack_from(data)[0] < time.time():
+        return False
+
+    return hmac.compare_digest(_sign(data[:_PAYLOAD_SIZE]), data[_PAYLOAD_SIZE:])
+
+
+@click_helper.extend
+@click.option(
+    "--turn-secret",
+    help="Secret to sign tokens for TURN servers with; has to be the same for the coordinator and all TURN servers.",
+)
+def click_turn_secret(turn_secret):
+    global _secret
+
+    if turn_secret:
+        _secret = turn_secret.encode()
+    else:
+        log.warning("No TURN secret set; using a random one. Only TURN servers in this process can validate tokens.")
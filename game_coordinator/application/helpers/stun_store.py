@@ -0,0 +1,205 @@
+import asyncio
+import click
+import collections
+import logging
+import time
+
+from openttd_helpers import click_helper
+
+from ...openttd.timer_wheel import timer_wheel
+
+log = logging.getLogger(__name__)
+
+# Seconds a STUN result is kept; it is only needed while a connection attempt
+# is in progress.
+STUN_TTL = 60
+# Most STUN results kept at once; the oldest results are dropped first.
+STUN_MAX_SIZE = 100000
+# Seconds to wait for a STUN result that is reported, but not received yet.
+STUN_WAIT_TIMEOUT = 1
+
+# Prefixes of the tokens clients use for STUN: client, server, and verify.
+_PREFIXES = ("C", "S", "V")
+
+
+class StunStore:
+    """
+    The IP and port STUN requests came from, by (prefixed) token and
+    interface number.
+
+    Only results for tokens in "tokens" (the live tokens of the coordinator)
+    are accepted; anything else is something we didn't ask for. Results
+    expire after "ttl" seconds, and at most "max_size" tokens are kept.
+
+    The STUN request and the report of its result travel over different
+    connections, so the result can be reported before it is received;
+    subscribe() calls back once it arrives.
+    """
+
+    wait_timeout = STUN_WAIT_TIMEOUT
+    # Seconds between two logs of the stats; 0 to disable.
+    stats_interval = 0
+
+    def __init__(self, tokens, ttl=STUN_TTL, max_size=STUN_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._tokens = tokens
+        # Entries are in order of expiry, as the TTL is the same for all.
+        self._entries = collections.OrderedDict()
+        # Callbacks waiting for a result, by token and interface number.
+        self._waiters = {}
+        self._stats_task = None
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "waited": 0,
+            "rejected": 0,
+            "expired": 0,
+            "evicted": 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, token, interface_number, ip, port):
+        """Store a STUN result. Returns False if the token is unknown."""
+
+        self._start_stats()
+
+        if token[:1] not in _PREFIXES or token[1:] not in self._tokens:
+            self.stats["rejected"] += 1
+            return False
+
+        now = time.monotonic()
+        self.expire(now)
+
+        # Re-inserting moves the token to the end, in line with its new expiry.
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            if len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evicted"] += 1
+            results = {}
+        else:
+            results = entry[1]
+
+        self._entries[token] = (now + self.ttl, results)
+        results[interface_number] = (ip, port)
+
+        waiters = self._waiters.get(token)
+        if waiters is not None and interface_number in waiters:
+            # A callback can delete the token; so remove the waiters first.
+            callbacks = waiters.pop(interface_number)
+            if not waiters:
+                del self._waiters[token]
+
+            for callback, timer in callbacks:
+                timer.cancel()
+                self.stats["waited"] += 1
+                callback(ip, port)
+
+        return True
+
+    def subscribe(self, token, interface_number, callback):
+        """
+        Call "callback" with the IP and port of a STUN result, as soon as
+        there is one. If none arrives within "wait_timeout" seconds, it is
+        called with (None, None).
+        """
+
+        result = self._lookup(token, interface_number)
+        if result:
+            self.stats["hits"] += 1
+            callback(*result)
+            return
+
+        # The timer needs to know which waiter to remove; so it is created
+        # after the waiter is.
+        waiter = [callback]
+        waiter.append(
+            timer_wheel.call_later(self.wait_timeout, self._subscription_timeout, token, interface_number, waiter)
+        )
+        self._waiters.setdefault(token, {}).setdefault(interface_number, []).append(waiter)
+
+    def _subscription_timeout(self, token, interface_number, waiter):
+        waiters = self._waiters[token]
+        waiters[interface_number].remove(waiter)
+        if not waiters[interface_number]:
+            del waiters[interface_number]
+            if not waiters:
+                del self._waiters[token]
+
+        self.stats["misses"] += 1
+        waiter[0](None, None)
+
+    def _lookup(self, token, interface_number):
+        entry = self._entries.get(token)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1].get(interface_number)
+
+    def delete_token(self, token):
+        """Delete the STUN results of a token, for all prefixes."""
+
+        for prefix in _PREFIXES:
+            self._entries.pop(f"{prefix}{token}", None)
+
+            # Nobody is interested in these results anymore.
+            for waiters in self._waiters.pop(f"{prefix}{token}", {}).values():
+                for _, timer in waiters:
+                    timer.cancel()
+
+    def expire(self, now):
+        while self._entries:
+            token, (expires, _) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+
+            del self._entries[token]
+            self.stats["expired"] += 1
+
+    def get_stats(self):
+        return dict(self.stats, size=len(self._entries))
+
+    def _start_stats(self):
+        if self._stats_task is None and self.stats_interval:
+            self._stats_task = asyncio.create_task(self._log_stats())
+
+    async def _log_stats(self):
+        # Log what an operator needs to judge whether the TTL, size, and wait
+        # timeout fit the traffic.
+        while True:
+            await asyncio.sleep(self.stats_interval)
+
+            stats = self.get_stats()
+            log.info(
+                f"STUN stats: {stats['size']} tokens stored, {stats['hits']} hits, {stats['waited']} waited for, "
+                f"{stats['misses']} misses, {stats['rejected']} rejected, {stats['expired']} expired, "
+                f"{stats['evicted']} evicted"
+            )
+
+
+@click_helper.extend
+@click.option(
+    "--stun-wait-timeout",
+    help="Seconds to wait for a STUN result that is reported by a client, but not received by the STUN server yet.",
+    default=STUN_WAIT_TIMEOUT,
+    show_default=True,
+    type=click.FloatRange(min=0),
+)
+def click_stun_wait_timeout(stun_wait_timeout):
+    StunStore.wait_timeout = stun_wait_timeout
+
+
+@click_helper.extend
+@click.option(
+    "--stun-stats-interval",
+    help="Seconds between two logs of the STUN result stats (0 to disable).",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+def click_stun_stats_interval(stun_stats_interval):
+    StunStore.stats_interval = stun_stats_interval
@@ -1,7 +1,7 @@
-import asyncio
 import logging
 
 from .enums import (
+    ConnectState,
     ConnectType,
     Family,
 )
@@ -10,11 +10,34 @@ from .ip import (
     ip_to_str,
 )
 from ...openttd.protocol.enums import ConnectionType
+from ...openttd.protocol.exceptions import SocketClosed
+from ...openttd.timer_wheel import timer_wheel
 
 log = logging.getLogger(__name__)
 
+# Seconds to wait for a new way to connect, before falling back to TURN.
+METHOD_TIMEOUT = 1
+# Seconds a way to connect has to succeed or fail, before trying the next.
+STEP_TIMEOUT = 4
+
 
 class TokenConnect:
+    """
+    Find a way for a client to connect to a server.
+
+    This is a state machine, driven by the packets of the client and server
+    and by timers. It is WAITING for a new way to connect (direct, or STUN
+    once both sides reported their STUN results), or TRYING one till it
+    succeeds, fails, or times out. If no new way shows up in time, TURN is
+    tried as the final attempt.
+
+    Everything is done right away, from the packet handlers and timers;
+    packets to either side are sent without waiting (see
+    send_packet_nowait()), so the handler of one side never waits for the
+    connection of the other side. If either side is gone, they can't be
+    connected anymore; the other side is told so.
+    """
+
     def __init__(self, token, server, client_source):
         self.token = token
 
@@ -24,8 +47,9 @@ class TokenConnect:
         self._server_source = server._source
         self._client_source = client_source
 
-        self._task = None
-        self._is_connected = False
+        self._state = ConnectState.IDLE
+        self._timer = None
+        self._final_attempt = False
         self._stuns = 0
         self._tracking_number = 0
 
@@ -38,52 +62,49 @@ class TokenConnect:
             Family.IPv6: False,
         }
 
-        self._turn_server = None
-        self._turn_client = None
-        self._turn_connected = asyncio.Event()
-
-        self._wait_step = asyncio.Event()
-        self._stun_done = False
-
-        self._connect_methods = asyncio.Queue()
+        self._connect_methods = []
         if self._server.connection_type[get_family(client_source.ip)] == ConnectionType.CONNECTION_TYPE_DIRECT:
-            self._connect_methods.put_nowait(lambda: self.connect_direct(get_family(client_source.ip)))
-        self._connect_methods.put_nowait(lambda: self.connect_start_stun())
-
-    def _get_stun_info(self, prefix, interface_number):
-        return self._server._application.storage_stun.get(f"{prefix}{self.token}", {}).get(
-            interface_number, (None, None)
-        )
+            self._connect_methods.append(lambda: self.connect_direct(get_family(client_source.ip)))
+        self._connect_methods.append(lambda: self.connect_start_stun())
 
     def disconnect(self):
-        if self._task:
-            self._task.cancel()
+        self._state = ConnectState.DONE
+        if self._timer:
+            self._timer.cancel()
+
+    def connect(self):
+        self._run(self._next_method)
 
-    async def connect(self):
-        self._task = asyncio.create_task(self._start_connect())
+    def connect_failed(self, prefix, tracking_number):
+        # A failure of an earlier attempt, which timed out already.
+        if self._state != ConnectState.TRYING or self._tracking_number != tracking_number:
+            return
 
-    async def connect_failed(self, prefix, tracking_number):
-        if self._tracking_number == tracking_number:
-            self._wait_step.set()
+        self._timer.cancel()
+        self._timer = None
+        self._run(self._next_step)
 
-    async def connected(self):
-        self._is_connected = True
-        self._wait_step.set()
+    def connected(self):
+        self._finish_connected()
 
-    async def stun_result(self, prefix, interface_number, result):
+    def stun_result(self, prefix, interface_number, result):
         self._stuns += 1
 
         if not result:
             return
 
-        ip, port = self._get_stun_info(prefix, interface_number)
-        if ip is None:
-            log.info("STUN info not received yet, retrying ..")
-            # The message over the STUN protocol can be a bit later than the
-            # STUN_RESULT packet over the GC protocol, so wait a bit till it
-            # (possibly) arrives.
-            await asyncio.sleep(0.1)
-            ip, port = self._get_stun_info("V", interface_number)
+        # The message over the STUN protocol can be a bit later than the
+        # STUN_RESULT packet over the GC protocol; if so, the store calls us
+        # once it arrives.
+        self._server._application.stun_store.subscribe(
+            f"{prefix}{self.token}",
+            interface_number,
+            lambda ip, port: self._stun_received(prefix, interface_number, ip, port),
+        )
+
+    def _stun_received(self, prefix, interface_number, ip, port):
+        if self._state == ConnectState.DONE:
+            return
 
         if ip is None:
             log.error("Got STUN result packet but we don't have a STUN result on file")
@@ -99,7 +120,7 @@ class TokenConnect:
                 family != get_family(self._client_source.ip)
                 and self._server.connection_type[family] == ConnectionType.CONNECTION_TYPE_DIRECT
             ):
-                self._connect_methods.put_nowait(lambda: self.connect_direct(family))
+                self._add_method(lambda: self.connect_direct(family))
 
         if prefix == "S":
             self._server_stun[family] = (interface_number, ip, port)
@@ -120,86 +141,123 @@ class TokenConnect:
 
         # Found a matching STUN pair.
         self._stun_tried[client_family] = True
-        self._connect_methods.put_nowait(lambda: self.connect_stun(client_family))
+        self._add_method(lambda: self.connect_stun(client_family))
 
-    async def _start_connect(self):
-        try:
-            await self._real_start_connect()
-        except asyncio.CancelledError:
-            pass
-
-    async def _real_start_connect(self):
-        _final_attempt = False
-
-        while True:
-            if self._stuns == 4 and self._connect_methods.empty():
-                # If we got two * two results, assume it is an IPv4 / IPv6 pair,
-                # and we are done. Although OpenTTD client implements this, the
-                # protocol leaves room for this to be a false statement. Yet, it
-                # makes joining a lot quicker, so we are going with it for now.
-                _final_attempt = True
-                func = self.connect_turn
-            else:
-                # Wait for a new method to present itself.
-                try:
-                    func = await asyncio.wait_for(self._connect_methods.get(), 1)
-                except asyncio.TimeoutError:
-                    _final_attempt = True
-                    func = self.connect_turn
-
-            # Try the new method.
-            self._wait_step.clear()
-            await func()
-
-            # Wait for the method to result in anything useful.
-            try:
-                await asyncio.wait_for(self._wait_step.wait(), 4)
-            except asyncio.TimeoutError:
-                pass
+    def _add_method(self, method):
+        self._connect_methods.append(method)
 
-            # If we are now connected or this was the final attempt, we are all done.
-            if self._is_connected or _final_attempt:
-                break
+        if self._state == ConnectState.WAITING:
+            self._timer.cancel()
+            self._timer = None
+            self._run(self._next_method)
+
+    def _run(self, action):
+        if self._state == ConnectState.DONE:
+            return
 
-        if self._is_connected:
-            log.info(
-                f"Happy customer {self._client_source.ip} via {self.connect_state[0].value} "
-                f"(S: {self.connect_state[1].value}, C: {self.connect_state[2].value})"
-            )
+        try:
+            action()
+        except SocketClosed:
+            # Either side is gone; they can't be connected anymore.
+            self._finish_failed()
+
+    def _next_method(self):
+        if self._stuns == 4 and not self._connect_methods:
+            # If we got two * two results, assume it is an IPv4 / IPv6 pair,
+            # and we are done. Although OpenTTD client implements this, the
+            # protocol leaves room for this to be a false statement. Yet, it
+            # makes joining a lot quicker, so we are going with it for now.
+            self._try(self.connect_turn, final_attempt=True)
+        elif self._connect_methods:
+            self._try(self._connect_methods.pop(0))
+        else:
+            # Wait for a new method to present itself.
+            self._state = ConnectState.WAITING
+            self._timer = timer_wheel.call_later(METHOD_TIMEOUT, self._timeout)
+
+    def _try(self, method, final_attempt=False):
+        self._state = ConnectState.TRYING
+        self._final_attempt = final_attempt
+
+        # Wait for the method to result in anything useful; unless there is
+        # nothing to wait for.
+        if method():
+            self._next_step()
         else:
-            # Even TURN failed, so we should tell the clients we have no way
-            # of connecting them.
-            await self._server_source.protocol.send_PACKET_COORDINATOR_SERVER_CONNECT_FAILED(f"S{self.token}")
-            await self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_CONNECT_FAILED(f"C{self.token}")
+            self._timer = timer_wheel.call_later(STEP_TIMEOUT, self._timeout)
+
+    def _next_step(self):
+        # If this was the final attempt, we are all done.
+        if self._final_attempt:
+            self._finish_failed()
+        else:
+            self._next_method()
+
+    def _timeout(self):
+        self._timer = None
 
-            log.info(f"Sad customer {self._client_source.ip} for {self._server_source.ip}")
+        if self._state == ConnectState.WAITING:
+            self._run(lambda: self._try(self.connect_turn, final_attempt=True))
+        elif self._state == ConnectState.TRYING:
+            self._run(self._next_step)
 
-        self._task = None
+    def _finish_connected(self):
+        if self._state == ConnectState.DONE:
+            return
+
+        self._state = ConnectState.DONE
+        if self._timer:
+            self._timer.cancel()
+
+        log.info(
+            f"Happy customer {self._client_source.ip} via {self.connect_state[0].value} "
+            f"(S: {self.connect_state[1].value}, C: {self.connect_state[2].value})"
+        )
 
-    async def connect_direct(self, family):
+    def _finish_failed(self):
+        if self._state == ConnectState.DONE:
+            return
+
+        self._state = ConnectState.DONE
+        if self._timer:
+            self._timer.cancel()
+
+        # Even TURN failed, so we should tell the clients we have no way
+        # of connecting them; at least, those that are still there.
+        for prefix, source in (("S", self._server_source), ("C", self._client_source)):
+            try:
+                source.protocol.send_PACKET_COORDINATOR_SERVER_CONNECT_FAILED(f"{prefix}{self.token}")
+            except SocketClosed:
+                pass
+
+        log.info(f"Sad customer {self._client_source.ip} for {self._server_source.ip}")
+        self._server._application.delete_token(self.token)
+
+    def connect_direct(self, family):
         self._tracking_number += 1
         self.connect_state = [ConnectType.DIRECT, family, family]
-        await self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_DIRECT_CONNECT(
+        self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_DIRECT_CONNECT(
             f"C{self.token}", self._tracking_number, ip_to_str(self._server.server_ip[family]), self._server.server_port
         )
 
-    async def connect_start_stun(self):
-        await self._server_source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_REQUEST(f"S{self.token}")
-        await self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_REQUEST(f"C{self.token}")
+    def connect_start_stun(self):
+        self._server_source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_REQUEST(f"S{self.token}")
+        self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_REQUEST(f"C{self.token}")
 
-        self._wait_step.set()
+        # The STUN results are new ways to connect; there is nothing to wait for.
+        return True
 
-    async def connect_stun(self, family):
+    def connect_stun(self, family):
         self._tracking_number += 1
         self.connect_state = [ConnectType.STUN, family, family]
-        await self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_CONNECT(
+        self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_CONNECT(
             f"C{self.token}",
             self._tracking_number,
             self._client_stun[family][0],
             ip_to_str(self._server_stun[family][1]),
             self._server_stun[family][2],
         )
-        await self._server_source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_CONNECT(
+        self._server_source.protocol.send_PACKET_COORDINATOR_SERVER_STUN_CONNECT(
             f"S{self.token}",
             self._tracking_number,
             self._server_stun[family][0],
@@ -207,13 +265,17 @@ class TokenConnect:
             self._client_stun[family][2],
         )
 
-    async def connect_turn(self):
+    def connect_turn(self):
+        turn_server = self._server._application.turn_pool.pick()
+        if turn_server is None:
+            log.error("No TURN server available")
+            return True
+
         self._tracking_number += 1
         self.connect_state = [ConnectType.TURN, Family.UNKNOWN, Family.UNKNOWN]
-        # TODO -- Make a pool of TURN servers
-        await self._server_source.protocol.send_PACKET_COORDINATOR_SERVER_TURN_CONNECT(
-            f"S{self.token}", self._tracking_number, "coordinator.openttd.org", 3974
+        self._server_source.protocol.send_PACKET_COORDINATOR_SERVER_TURN_CONNECT(
+            f"S{self.token}", self._tracking_number, turn_server.host, turn_server.port
         )
-        await self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_TURN_CONNECT(
-            f"C{self.token}", self._tracking_number, "coordinator.openttd.org", 3974
+        self._client_source.protocol.send_PACKET_COORDINATOR_SERVER_TURN_CONNECT(
+            f"C{self.token}", self._tracking_number, turn_server.host, turn_server.port
         )
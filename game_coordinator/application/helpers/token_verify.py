@@ -1,15 +1,66 @@
 import asyncio
 import logging
+import socket
 
+from .enums import Family
 from .ip import get_family
 from ...openttd.protocol.enums import ConnectionType
+from ...openttd.timer_wheel import timer_wheel
 
 log = logging.getLogger(__name__)
 
+# Seconds the server has to accept a direct connection.
+DIRECT_CONNECT_TIMEOUT = 1
 
-class ConnectAndCloseProtocol(asyncio.Protocol):
-    def connection_made(self, transport):
-        transport.close()
+
+class ConnectCheck:
+    """
+    Check whether a connection can be made to "ip" on "port", and close it
+    right away.
+
+    "callback" is called with True or False once this is known, unless the
+    check is cancelled before. The socket is watched by the event loop, and
+    the timeout is on the timer wheel; no task is needed.
+    """
+
+    def __init__(self, ip, port, callback):
+        self._callback = callback
+        self._loop = asyncio.get_event_loop()
+        self._timer = None
+
+        family = socket.AF_INET6 if get_family(ip) == Family.IPv6 else socket.AF_INET
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+
+        try:
+            self._sock.connect((str(ip), port))
+        except BlockingIOError:
+            self._loop.add_writer(self._sock.fileno(), self._connected)
+            self._timer = timer_wheel.call_later(DIRECT_CONNECT_TIMEOUT, self._finish, False)
+        except OSError:
+            self._loop.call_soon(self._finish, False)
+        else:
+            self._loop.call_soon(self._finish, True)
+
+    def cancel(self):
+        if self._sock is None:
+            return
+
+        if self._timer:
+            self._timer.cancel()
+        self._loop.remove_writer(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+
+    def _connected(self):
+        self._finish(self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0)
+
+    def _finish(self, success):
+        if self._sock is None:
+            return
+
+        self.cancel()
+        self._callback(success)
 
 
 class TokenVerify:
@@ -19,64 +70,64 @@ class TokenVerify:
         self._family = {}
 
         self._stuns = 0
+        # STUN results reported, but not handled yet.
+        self._pending = 0
+        self._checks = set()
 
     def disconnect(self):
-        pass
-
-    def _get_stun_info(self, prefix, interface_number):
-        return self._server._application.storage_stun.get(f"{prefix}{self.token}", {}).get(
-            interface_number, (None, None)
-        )
+        for check in self._checks:
+            check.cancel()
+        self._checks.clear()
 
-    async def stun_result(self, prefix, interface_number, result):
+    def stun_result(self, prefix, interface_number, result):
         self._stuns += 1
 
         if not result:
-            # If we got two results, assume it is an IPv4 / IPv6 pair, and we
-            # are done. Although OpenTTD client implements this, the protocol
-            # leaves room for this to be a false statement. Yet, it makes
-            # registering a lot quicker, so we are going with it for now.
-            if self._stuns == 2:
-                self._server._detection_done.set()
+            self._check_done()
             return
 
-        server_ip, _ = self._get_stun_info("V", interface_number)
-        if server_ip is None:
-            log.info("STUN info not received yet, retrying ..")
-            # The message over the STUN protocol can be a bit later than the
-            # STUN_RESULT packet over the GC protocol, so wait a bit till it
-            # (possibly) arrives.
-            await asyncio.sleep(0.1)
-            server_ip, _ = self._get_stun_info("V", interface_number)
+        # The message over the STUN protocol can be a bit later than the
+        # STUN_RESULT packet over the GC protocol; if so, the store calls us
+        # once it arrives.
+        self._pending += 1
+        self._server._application.stun_store.subscribe(f"V{self.token}", interface_number, self._stun_received)
 
+    def _stun_received(self, server_ip, server_port):
         if server_ip is None:
             log.error("Got STUN result packet but we don't have a STUN result on file")
+            self._pending -= 1
+            self._check_done()
             return
 
         family = get_family(server_ip)
         self._server.server_ip[family] = server_ip
 
-        # First, see if we can direct connect to this IP.
-        if await self._detect_direct_ip(server_ip):
-            pass
+        # First, see if we can direct connect to this IP. This takes a while;
+        # don't hold up the packets of the server.
+        check = ConnectCheck(
+            server_ip,
+            self._server.server_port,
+            lambda success: self._direct_ip_checked(check, family, success),
+        )
+        self._checks.add(check)
+
+    def _direct_ip_checked(self, check, family, success):
+        self._checks.discard(check)
+
+        if success:
+            self._server.connection_type[family] = ConnectionType.CONNECTION_TYPE_DIRECT
         else:
             # We don't really try a STUN request; we just assumes every client
             # can be STUN'd, so we gather stats for those that cannot.
             self._server.connection_type[family] = ConnectionType.CONNECTION_TYPE_STUN
 
-        if self._stuns == 2:
-            self._server._detection_done.set()
+        self._pending -= 1
+        self._check_done()
 
-    async def _detect_direct_ip(self, ip):
-        try:
-            await asyncio.wait_for(
-                asyncio.get_event_loop().create_connection(
-                    lambda: ConnectAndCloseProtocol(), host=str(ip), port=self._server.server_port
-                ),
-                1,
-            )
-            self._server.connection_type[get_family(ip)] = ConnectionType.CONNECTION_TYPE_DIRECT
-        except (OSError, ConnectionRefusedError, asyncio.TimeoutError):
-            return False
-
-        return True
+    def _check_done(self):
+        # If we got two results, assume it is an IPv4 / IPv6 pair, and we
+        # are done. Although OpenTTD client implements this, the protocol
+        # leaves room for this to be a false statement. Yet, it makes
+        # registering a lot quicker, so we are going with it for now.
+        if self._stuns == 2 and not self._pending:
+            self._server.detection_done(self)
@@ -0,0 +1,183 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+
+from .signed_token import create_signed_token
+from ...openttd.protocol.enums import PacketTCPTurnType
+from ...openttd.protocol.exceptions import PacketInvalid
+from ...openttd.protocol.packets import TURN_PACKETS
+from ...openttd.protocol.read import (
+    PacketReader,
+    peek_uint16,
+)
+from ...openttd.protocol.schema import (
+    create_decoder,
+    create_encoder,
+)
+from ...openttd.timer_wheel import timer_wheel
+
+log = logging.getLogger(__name__)
+
+# Seconds between two health checks of every TURN server.
+HEALTH_CHECK_INTERVAL = 10
+# Seconds a TURN server has to report its load during a health check.
+HEALTH_CHECK_TIMEOUT = 2
+# Seconds a handed out TURN server counts as extra load, as it takes a while
+# before the relay shows up in the stats (if at all).
+ASSIGNMENT_WINDOW = 10
+
+_encode_PACKET_TURN_CLIENT_STATS = create_encoder(
+    TURN_PACKETS[PacketTCPTurnType.PACKET_TURN_CLIENT_STATS], PacketTCPTurnType.PACKET_TURN_CLIENT_STATS
+)
+_decode_PACKET_TURN_SERVER_STATS = create_decoder(TURN_PACKETS[PacketTCPTurnType.PACKET_TURN_SERVER_STATS])
+
+
+class TurnStatsProtocol(asyncio.Protocol):
+    """Ask a TURN server for its load; "stats" is set to the answer, or None if there was none."""
+
+    def __init__(self):
+        self.stats = asyncio.get_event_loop().create_future()
+        self._data = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # The token proves to the TURN server the question comes from the coordinator.
+        transport.write(_encode_PACKET_TURN_CLIENT_STATS(protocol_version=1, token=create_signed_token()))
+
+    def data_received(self, data):
+        self._data += data
+        if len(self._data) < 2:
+            return
+        length = peek_uint16(self._data)
+        if len(self._data) < length:
+            return
+
+        stats = None
+        reader = PacketReader(self._data, 2, length)
+        try:
+            if reader.read_uint8() == PacketTCPTurnType.PACKET_TURN_SERVER_STATS:
+                stats = _decode_PACKET_TURN_SERVER_STATS(None, reader)
+        except PacketInvalid:
+            pass
+
+        if not self.stats.done():
+            self.stats.set_result(stats)
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        if not self.stats.done():
+            self.stats.set_result(None)
+
+
+class TurnServer:
+    """
+    A TURN server clients can be sent to.
+
+    If "load" is given, it is called to get the load of the TURN server;
+    this is the case for TURN servers in the same process. Otherwise, the
+    TURN server is asked for its load during the health check; at
+    "check_address" (a tuple of host and port) if given, as the address
+    clients are sent to is not always reachable from here. Between two
+    health checks, clients sent to it recently count as extra load.
+    """
+
+    def __init__(self, host, port, load=None, check_address=None):
+        self.host = host
+        self.port = port
+        self.check_address = check_address or (host, port)
+        self.alive = True
+        self.relays = 0
+        self.bytes_per_sec = 0
+
+        self._load = load
+        self._assigned = collections.deque()
+        self._reported = True
+
+    def __repr__(self):
+        return f"TurnServer(host={self.host!r}, port={self.port!r})"
+
+    def get_load(self, now):
+        while self._assigned and self._assigned[0] < now - ASSIGNMENT_WINDOW:
+            self._assigned.popleft()
+        return (self.relays + len(self._assigned), self.bytes_per_sec)
+
+    def assign(self, now):
+        self._assigned.append(now)
+
+    async def check(self):
+        if self._load is not None:
+            load = self._load()
+        else:
+            host, port = self.check_address
+            try:
+                async with timer_wheel.timeout(HEALTH_CHECK_TIMEOUT):
+                    _, protocol = await asyncio.get_event_loop().create_connection(
+                        lambda: TurnStatsProtocol(), host=host, port=port
+                    )
+                    load = await protocol.stats
+            except (OSError, asyncio.TimeoutError):
+                return False
+
+            # It accepts connections, but doesn't tell its load: either it
+            # doesn't know this packet, or it has another TURN secret.
+            # Estimating its load from the clients sent to it is the best
+            # that can be done.
+            if load is None:
+                if self._reported:
+                    log.warning(
+                        f"TURN server {self.host}:{self.port} doesn't report its load; is --turn-secret the same?"
+                    )
+                self._reported = False
+                return True
+
+        self._reported = True
+        self.relays = load["relays"]
+        self.bytes_per_sec = load["bytes_per_sec"]
+        return True
+
+
+class TurnPool:
+    def __init__(self):
+        self._servers = []
+        self._task = None
+
+    def add(self, host, port, load=None, check_address=None):
+        self._servers.append(TurnServer(host, port, load, check_address))
+
+    def pick(self):
+        """Pick the TURN server to send the next relay to, or None if there is none alive."""
+
+        if self._task is None and self._servers:
+            self._task = asyncio.create_task(self._health_check())
+
+        servers = [server for server in self._servers if server.alive]
+        if not servers:
+            return None
+
+        # Power of two choices: pick two random TURN servers, and use the
+        # least loaded of the two. This spreads the load nearly as well as
+        # always picking the least loaded, without all coordinators (or all
+        # clients within a single stats interval) going to the same one.
+        now = time.monotonic()
+        if len(servers) > 1:
+            servers = random.sample(servers, 2)
+        server = min(servers, key=lambda server: server.get_load(now))
+
+        server.assign(now)
+        return server
+
+    async def _health_check(self):
+        while True:
+            results = await asyncio.gather(*[server.check() for server in self._servers])
+
+            for server, alive in zip(self._servers, results):
+                if server.alive != alive:
+                    if alive:
+                        log.info(f"TURN server {server.host}:{server.port} is back")
+                    else:
+                        log.warning(f"TURN server {server.host}:{server.port} is not reachable; not using it")
+                server.alive = alive
+
+            await timer_wheel.sleep(HEALTH_CHECK_INTERVAL)
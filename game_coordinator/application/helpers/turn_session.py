@@ -0,0 +1,49 @@
+import time
+
+
+class TurnSession:
+    """
+    A client and a server meeting on the TURN server with the same token.
+
+    "sides" contains the sources that connected, by their prefix ("C" for
+    the client, "S" for the server).
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.sides = {}
+        self.started = None
+        # Timer for the pairing timeout, or once started, the idle check.
+        self.timer = None
+
+        self._relay_bytes = 0
+        self._active_at = None
+
+    @property
+    def client(self):
+        return self.sides["C"]
+
+    @property
+    def server(self):
+        return self.sides["S"]
+
+    def is_paired(self):
+        return "C" in self.sides and "S" in self.sides
+
+    def start(self):
+        self.started = time.time()
+        self._active_at = time.monotonic()
+
+    def get_idle_time(self, now):
+        # Any byte relayed in either direction since the last check counts
+        # as activity.
+        relay_bytes = self.client.protocol.relay_bytes + self.server.protocol.relay_bytes
+        if relay_bytes != self._relay_bytes:
+            self._relay_bytes = relay_bytes
+            self._active_at = now
+
+        return now - self._active_at
+
+    def abort(self):
+        for source in self.sides.values():
+            source.protocol.transport.abort()
@@ -9,7 +9,10 @@ class Application:
 
         self._coordinator = coordinator
 
-    async def receive_PACKET_STUN_CLIENT_STUN(self, source, interface_number, token):
-        self._coordinator.storage_stun[token][interface_number] = (source.ip, source.port)
+    def receive_PACKET_STUN_CLIENT_STUN(self, source, protocol_version, interface_number, token):
+        if not self._coordinator.stun_store.put(token, interface_number, source.ip, source.port):
+            log.info(f"Closing STUN connection from {source.ip}: unknown token")
+            source.protocol.transport.close()
+            return
 
         # TODO -- Start a timeout to close the connection
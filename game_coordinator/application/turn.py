@@ -1,36 +1,138 @@
+import asyncio
+import click
 import logging
+import resource
 import time
 
-from collections import defaultdict
+from openttd_helpers import click_helper
 
 from .helpers.ip import ip_to_str
+from .helpers.signed_token import validate_signed_token
+from .helpers.turn_session import TurnSession
+from ..openttd.shaper import RATE_INTERVAL
+from ..openttd.tcp_turn import OpenTTDProtocolTCPTurn
+from ..openttd.timer_wheel import timer_wheel
 
 log = logging.getLogger(__name__)
 
+# Seconds the other side has to connect, after the first side connected.
+PAIRING_TIMEOUT = 30
+# Seconds a relay can go without relaying a single byte, before it is closed.
+IDLE_TIMEOUT = 60
+# Seconds between two checks whether a relay is idle.
+IDLE_CHECK_INTERVAL = 5
+
+
+def _get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _get_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Not Linux; the peak is the best we have.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
 
 class Application:
-    def __init__(self, coordinator):
+    # Seconds between two logs of the relay stats; 0 to disable.
+    stats_interval = 0
+
+    def __init__(self, coordinator, workers=None):
         super().__init__()
 
         self._coordinator = coordinator
-        self._relays = defaultdict(lambda: {})
-        self._started = {}
+        self._workers = workers
+        self._sessions = {}
+        self._active_relays = {}
+        self._stats_task = None
+        self._relay_bytes = 0
+        self._idle_rss = _get_rss()
+        self._load_at = time.monotonic()
+        self._load_bytes = 0
+        self._bytes_per_sec = 0
+
+    def get_stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "relays": len(self._active_relays),
+            # Relays forwarded in the kernel, with splice().
+            "spliced_relays": sum(session.client.protocol.is_spliced() for session in self._active_relays.values()),
+            "relay_memory": sum(
+                source.protocol.get_relay_memory()
+                for session in self._active_relays.values()
+                for source in session.sides.values()
+            ),
+            # Total bytes relayed since start.
+            "relay_bytes": self._get_relay_bytes(),
+            # Current bytes/sec; in total, per source IP, and per relay.
+            "rates": self.get_rates(),
+        }
+
+    def get_load(self):
+        """Get the load of this TURN server, as reported to the coordinator."""
+
+        now = time.monotonic()
+        if now - self._load_at >= RATE_INTERVAL:
+            relay_bytes = self._get_relay_bytes()
+            self._bytes_per_sec = (relay_bytes - self._load_bytes) / (now - self._load_at)
+            self._load_at, self._load_bytes = now, relay_bytes
+
+        # Tokens are spread evenly over the workers, and so are the relays;
+        # the load of this worker stands for that of every worker.
+        workers = self._workers.count if self._workers else 1
+        return {
+            "relays": len(self._active_relays) * workers,
+            "bytes_per_sec": int(self._bytes_per_sec * workers),
+        }
+
+    def _get_relay_bytes(self):
+        return self._relay_bytes + sum(
+            source.protocol.relay_bytes for session in self._active_relays.values() for source in session.sides.values()
+        )
+
+    def get_rates(self):
+        now = time.monotonic()
+
+        rates = OpenTTDProtocolTCPTurn.shaper.get_rates()
+        rates["relays"] = {
+            token: session.client.protocol.relay_bucket.get_rate(now) for token, session in self._active_relays.items()
+        }
+        return rates
 
     def disconnect(self, source):
         if not hasattr(source, "token"):
             return
 
+        prefix = source.token[0]
+        token = source.token[1:]
+
+        session = self._sessions.get(token)
+        if session is None or session.sides.get(prefix) is not source:
+            return
+
+        # Not paired yet; just forget about this side.
+        if session.started is None:
+            del session.sides[prefix]
+            if not session.sides:
+                session.timer.cancel()
+                del self._sessions[token]
+            return
+
         # Also close the other side.
         if source.protocol.relay_peer:
             if source.protocol.relay_peer.protocol.relay_peer is None:
-                if source.token[0] == "C":
-                    client = source
-                    server = source.protocol.relay_peer
-                else:
-                    client = source.protocol.relay_peer
-                    server = source
+                client = session.client
+                server = session.server
 
-                delta = time.time() - self._started[source.token[1:]]
+                delta = time.time() - session.started
+                session.timer.cancel()
+                del self._sessions[token]
+                del self._active_relays[token]
+                self._relay_bytes += client.protocol.relay_bytes + server.protocol.relay_bytes
 
                 log.info(f"Stopped relay for {client.ip} <-> {server.ip} after {delta} seconds")
                 log.info(
@@ -42,31 +144,137 @@ class Application:
                     f"{server.protocol.relay_bytes / delta} bytes/sec"
                 )
 
+                stats = self.get_stats()
+                log.info(f"  Active relays: {stats['relays']}, buffering {stats['relay_memory']} bytes")
+
             source.protocol.relay_peer.protocol.transport.close()
             source.protocol.relay_peer = None
 
-    async def receive_PACKET_TURN_CLIENT_CONNECT(self, source, token):
+    def _expire_session(self, session):
+        log.info(f"Closing TURN session {session.token}: other side didn't connect in time")
+        del self._sessions[session.token]
+        session.abort()
+
+    def _check_idle(self, session):
+        idle_time = session.get_idle_time(time.monotonic())
+        if idle_time >= IDLE_TIMEOUT:
+            log.info(f"Closing relay for {session.client.ip} <-> {session.server.ip}: idle")
+            session.abort()
+            return
+
+        session.timer = timer_wheel.call_later(
+            min(IDLE_CHECK_INTERVAL, IDLE_TIMEOUT - idle_time), self._check_idle, session
+        )
+
+    def _start_stats(self):
+        if self._stats_task is None and self.stats_interval:
+            self._stats_task = asyncio.create_task(self._log_stats())
+
+    async def _log_stats(self):
+        # Log what an operator needs to judge how the relays perform: how
+        # much is relayed, at what CPU cost, and how much memory it takes.
+        stats = self.get_stats()
+        logged_at, cpu_time, relay_bytes = time.monotonic(), _get_cpu_time(), stats["relay_bytes"]
+
+        while True:
+            await asyncio.sleep(self.stats_interval)
+
+            stats = self.get_stats()
+            now, cpu_now = time.monotonic(), _get_cpu_time()
+            relayed = stats["relay_bytes"] - relay_bytes
+            cpu_per_gb = (cpu_now - cpu_time) / (relayed / 1e9) if relayed else 0
+            rss = _get_rss()
+            rss_per_relay = (rss - self._idle_rss) // stats["relays"] if stats["relays"] else 0
+
+            log.info(
+                f"Relay stats: {stats['relays']} relays ({stats['spliced_relays']} spliced), "
+                f"{stats['sessions']} sessions, {relayed / (now - logged_at):.0f} bytes/sec, "
+                f"{cpu_per_gb:.2f} CPU-seconds per GB relayed, "
+                f"buffering {stats['relay_memory']} bytes, RSS {rss} bytes ({rss_per_relay} bytes per relay)"
+            )
+
+            logged_at, cpu_time, relay_bytes = now, cpu_now, stats["relay_bytes"]
+
+    async def receive_PACKET_TURN_CLIENT_CONNECT(self, source, protocol_version, token):
         prefix = token[0]
         token = token[1:]
-        self._relays[token][prefix] = source
 
-        # TODO -- Validate tokens
+        # Tokens are signed by the coordinator; this means we can validate
+        # them without having to ask the coordinator.
+        if prefix not in ("C", "S") or not validate_signed_token(token):
+            log.info(f"Closing connection from {source.ip}: invalid or expired token")
+            source.protocol.transport.close()
+            return
 
-        if "C" in self._relays[token] and "S" in self._relays[token]:
-            client = self._relays[token]["C"]
-            server = self._relays[token]["S"]
+        # Both sides of a relay have to be in the same worker.
+        if self._workers and not self._workers.is_local(token):
+            self._workers.hand_over(source, token)
+            return
 
-            client.token = f"C{token}"
-            server.token = f"S{token}"
+        session = self._sessions.get(token)
+        if session is None:
+            session = TurnSession(token)
+            session.timer = timer_wheel.call_later(PAIRING_TIMEOUT, self._expire_session, session)
+            self._sessions[token] = session
+            self._start_stats()
 
-            server.protocol.relay_peer = client
-            client.protocol.relay_peer = server
+        if session.started is not None:
+            log.info(f"Closing connection from {source.ip} for relay that is already started")
+            source.protocol.transport.close()
+            return
+
+        # The same side connecting again replaces the earlier connection.
+        if prefix in session.sides:
+            session.sides[prefix].protocol.transport.abort()
+
+        session.sides[prefix] = source
+        source.token = f"{prefix}{token}"
+
+        if session.is_paired():
+            client = session.client
+            server = session.server
+
+            # Every relay can buffer up to "relay_memory"; don't start more
+            # relays than fit in the budget for all relays.
+            max_relays = source.protocol.relay_memory_budget // source.protocol.relay_memory
+            if len(self._active_relays) >= max_relays:
+                log.warning(f"Refusing relay for {client.ip} <-> {server.ip}: all {max_relays} relays are in use")
+                session.timer.cancel()
+                del self._sessions[token]
+                session.abort()
+                return
+
+            session.start()
+            session.timer.cancel()
+            session.timer = timer_wheel.call_later(IDLE_CHECK_INTERVAL, self._check_idle, session)
+            self._active_relays[token] = session
+            server.protocol.start_relay(client)
+            client.protocol.start_relay(server)
 
             await server.protocol.send_PACKET_TURN_SERVER_CONNECTED(ip_to_str(client.ip), client.port)
             await client.protocol.send_PACKET_TURN_SERVER_CONNECTED(ip_to_str(server.ip), server.port)
 
-            self._started[token] = time.time()
-
             log.info(f"Started relay for {client.ip} <-> {server.ip}")
 
-        # TODO -- Start a timeout to close idle connections
+    async def receive_PACKET_TURN_CLIENT_STATS(self, source, protocol_version, token):
+        # Only the coordinator can sign tokens, so only it gets to see the load.
+        if not validate_signed_token(token):
+            log.info(f"Closing connection from {source.ip}: invalid or expired token")
+            source.protocol.transport.close()
+            return
+
+        load = self.get_load()
+        await source.protocol.send_PACKET_TURN_SERVER_STATS(load["relays"], load["bytes_per_sec"])
+        source.protocol.transport.close()
+
+
+@click_helper.extend
+@click.option(
+    "--turn-stats-interval",
+    help="Seconds between two logs of the TURN relay stats (0 to disable).",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+def click_turn_stats_interval(turn_stats_interval):
+    Application.stats_interval = turn_stats_interval
@@ -30,7 +30,10 @@ class PacketTCPTurnType(enum.IntEnum):
     PACKET_TURN_SERVER_ERROR = 0
     PACKET_TURN_CLIENT_CONNECT = 1
     PACKET_TURN_SERVER_CONNECTED = 2
-    PACKET_TURN_END = 3
+    # Not part of OpenTTD; the coordinator asks TURN servers for their load.
+    PACKET_TURN_CLIENT_STATS = 3
+    PACKET_TURN_SERVER_STATS = 4
+    PACKET_TURN_END = 5
 
 
 class ServerGameType(enum.IntEnum):
@@ -0,0 +1,143 @@
+from .enums import (
+    PacketTCPCoordinatorType,
+    PacketTCPStunType,
+    PacketTCPTurnType,
+    ServerGameType,
+)
+from .schema import (
+    NewGRFs,
+    String,
+    UInt8,
+    UInt16,
+    UInt32,
+    UInt64,
+    Versioned,
+)
+
+PROTOCOL_VERSION = UInt8("protocol_version", valid=(1,), error="unknown protocol version: ")
+
+GAME_INFO = Versioned(
+    "game_info_version",
+    {
+        5: (
+            String("join_key"),
+            NewGRFs("newgrfs"),
+            UInt32("game_date"),
+            UInt32("start_date"),
+            UInt8("companies_max"),
+            UInt8("companies_on"),
+            UInt8("spectators_max"),
+            String("name"),
+            String("openttd_version"),
+            UInt8("use_password"),
+            UInt8("clients_max"),
+            UInt8("clients_on"),
+            UInt8("spectators_on"),
+            UInt16("map_width"),
+            UInt16("map_height"),
+            UInt8("map_type"),
+            UInt8("is_dedicated"),
+        ),
+    },
+    error="unknown game info version: ",
+)
+
+# The fields of every packet, in the order they are on the wire. The
+# SERVER_LISTING packet is a count followed by that many GAME_INFO entries,
+# and is assembled by the sender itself.
+COORDINATOR_PACKETS = {
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_ERROR: (
+        UInt8("error_no"),
+        String("error_detail"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_REGISTER: (
+        PROTOCOL_VERSION,
+        UInt8(
+            "game_type",
+            valid=range(ServerGameType.SERVER_GAME_TYPE_END),
+            error="invalid ServerGameType",
+            convert=ServerGameType,
+        ),
+        UInt16("server_port"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_REGISTER_ACK: (
+        String("join_key"),
+        UInt8("connection_type"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_UPDATE: (
+        PROTOCOL_VERSION,
+        GAME_INFO,
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_LISTING: (PROTOCOL_VERSION,),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECT: (
+        PROTOCOL_VERSION,
+        String("join_key"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_CONNECTING: (
+        String("token"),
+        String("join_key"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECT_FAILED: (
+        PROTOCOL_VERSION,
+        String("token"),
+        UInt8("tracking_number"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_CONNECT_FAILED: (String("token"),),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECTED: (
+        PROTOCOL_VERSION,
+        String("token"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_DIRECT_CONNECT: (
+        String("token"),
+        UInt8("tracking_number"),
+        String("server_host"),
+        UInt16("server_port"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_STUN_REQUEST: (String("token"),),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_STUN_CONNECT: (
+        String("token"),
+        UInt8("tracking_number"),
+        UInt8("interface_number"),
+        String("host"),
+        UInt16("port"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_STUN_RESULT: (
+        PROTOCOL_VERSION,
+        String("token"),
+        UInt8("family"),
+        UInt8("result"),
+    ),
+    PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_TURN_CONNECT: (
+        String("token"),
+        UInt8("tracking_number"),
+        String("host"),
+        UInt16("port"),
+    ),
+}
+
+STUN_PACKETS = {
+    PacketTCPStunType.PACKET_STUN_CLIENT_STUN: (
+        PROTOCOL_VERSION,
+        String("token"),
+        UInt8("interface_number"),
+    ),
+}
+
+TURN_PACKETS = {
+    PacketTCPTurnType.PACKET_TURN_CLIENT_CONNECT: (
+        PROTOCOL_VERSION,
+        String("token"),
+    ),
+    PacketTCPTurnType.PACKET_TURN_SERVER_CONNECTED: (
+        String("host"),
+        UInt16("port"),
+    ),
+    PacketTCPTurnType.PACKET_TURN_CLIENT_STATS: (
+        PROTOCOL_VERSION,
+        String("token"),
+    ),
+    PacketTCPTurnType.PACKET_TURN_SERVER_STATS: (
+        UInt32("relays"),
+        UInt64("bytes_per_sec"),
+    ),
+}
@@ -2,45 +2,73 @@ import struct
 
 from .exceptions import PacketInvalidData
 
+_uint8 = struct.Struct("<B")
+_uint16 = struct.Struct("<H")
+_uint32 = struct.Struct("<I")
+_uint64 = struct.Struct("<Q")
 
-def validate_length(data, length):
-    if len(data) < length:
-        raise PacketInvalidData("packet too short")
+# Initial size of the buffer every connection receives its packets in.
+RECEIVE_BUFFER_SIZE = 4096
 
 
-def read_uint8(data):
-    validate_length(data, 1)
-    value = struct.unpack("<B", data[0:1])
-    return value[0], data[1:]
+class PacketReader:
+    """
+    Cursor over the payload of a single packet.
 
+    Values are unpacked in place from the underlying buffer; only the
+    current offset is moved forward. This means reading a field never
+    copies the remainder of the packet.
+    """
 
-def read_uint16(data):
-    validate_length(data, 2)
-    value = struct.unpack("<H", data[0:2])
-    return value[0], data[2:]
+    def __init__(self, data, offset=0, end=None):
+        self._data = data
+        self._offset = offset
+        self._end = len(data) if end is None else end
 
+    def remaining(self):
+        return self._end - self._offset
 
-def read_uint32(data):
-    validate_length(data, 4)
-    value = struct.unpack("<I", data[0:4])
-    return value[0], data[4:]
+    def _validate_length(self, length):
+        if self._end - self._offset < length:
+            raise PacketInvalidData("packet too short")
 
+    def read_struct(self, s):
+        self._validate_length(s.size)
+        value = s.unpack_from(self._data, self._offset)
+        self._offset += s.size
+        return value
 
-def read_uint64(data):
-    validate_length(data, 8)
-    value = struct.unpack("<Q", data[0:8])
-    return value[0], data[8:]
+    def read_uint8(self):
+        return self.read_struct(_uint8)[0]
 
+    def read_uint16(self):
+        return self.read_struct(_uint16)[0]
 
-def read_bytes(data, count):
-    validate_length(data, count)
-    return data[0:count], data[count:]
+    def read_uint32(self):
+        return self.read_struct(_uint32)[0]
 
+    def read_uint64(self):
+        return self.read_struct(_uint64)[0]
 
-def read_string(data):
-    value = b""
-    while data[0:1] != b"\x00":
-        validate_length(data, 1)
-        value += data[0:1]
-        data = data[1:]
-    return value.decode(), data[1:]
+    def read_bytes(self, count):
+        self._validate_length(count)
+        value = bytes(self._data[self._offset : self._offset + count])
+        self._offset += count
+        return value
+
+    def read_string(self):
+        end = self._data.find(b"\x00", self._offset, self._end)
+        if end == -1:
+            raise PacketInvalidData("packet too short")
+
+        value = self._data[self._offset : end]
+        self._offset = end + 1
+
+        try:
+            return value.decode()
+        except UnicodeDecodeError:
+            raise PacketInvalidData("invalid UTF-8 string")
+
+
+def peek_uint16(data, offset=0):
+    return _uint16.unpack_from(data, offset)[0]
@@ -0,0 +1,235 @@
+import struct
+
+from .exceptions import PacketInvalidData
+from .write import PacketWriter
+
+_newgrf = struct.Struct("<I16s")
+
+# Names used by the generated code itself; fields can't use these.
+_RESERVED_NAMES = ("source", "reader", "writer", "values")
+
+
+class _Generator:
+    """Helper to build the source code of an encoder or decoder."""
+
+    def __init__(self):
+        self.namespace = {"PacketInvalidData": PacketInvalidData, "PacketWriter": PacketWriter}
+        self.lines = []
+
+    def constant(self, value):
+        name = f"_c{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def compile(self, name):
+        exec("\n".join(self.lines), self.namespace)
+        return self.namespace[name]
+
+
+class Field:
+    """
+    A single field of a packet.
+
+    "valid" optionally limits the values accepted when receiving; "convert"
+    is called on the received value (for example, to turn it into an enum).
+    """
+
+    # Format character for struct; None if the field is not of fixed size.
+    format = None
+
+    def __init__(self, name, valid=None, error=None, convert=None):
+        if not name.isidentifier() or name in _RESERVED_NAMES:
+            raise ValueError(f"invalid field name: {name}")
+
+        self.name = name
+        self.valid = valid
+        self.error = error or f"invalid {name}: "
+        self.convert = convert
+
+    def emit_check(self, gen, indent):
+        if self.valid is not None:
+            valid = gen.constant(self.valid)
+            error = gen.constant(self.error)
+            gen.emit(indent, f"if {self.name} not in {valid}:")
+            gen.emit(indent + 1, f"raise PacketInvalidData({error}, {self.name})")
+        if self.convert is not None:
+            gen.emit(indent, f"{self.name} = {gen.constant(self.convert)}({self.name})")
+
+
+class UInt8(Field):
+    format = "B"
+
+
+class UInt16(Field):
+    format = "H"
+
+
+class UInt32(Field):
+    format = "I"
+
+
+class UInt64(Field):
+    format = "Q"
+
+
+class String(Field):
+    def emit_read(self, gen, indent):
+        gen.emit(indent, f"{self.name} = reader.read_string()")
+
+    def emit_write(self, gen, indent, value):
+        gen.emit(indent, f"writer += {value}.encode()")
+        gen.emit(indent, "writer.append(0)")
+
+
+def _read_newgrfs(reader):
+    newgrf_mode = reader.read_uint8()
+    if newgrf_mode == 0:
+        return None
+
+    newgrf_count = reader.read_uint8()
+
+    newgrfs = []
+    for _ in range(newgrf_count):
+        newgrfs.append(reader.read_struct(_newgrf))
+        # Servers shouldn't be sending the name of the NewGRF, but we accept
+        # and ignore it. This is just to be protocol compatible.
+        if newgrf_mode == 2:
+            reader.read_string()
+
+    return newgrfs
+
+
+def _write_newgrfs(writer, newgrfs):
+    writer.write_uint8(1)  # has-newgrf-data
+    writer.write_uint8(len(newgrfs))
+    for newgrf in newgrfs:
+        writer += _newgrf.pack(*newgrf)
+
+
+class NewGRFs(Field):
+    """
+    List of (grfid, md5sum) tuples, prefixed by a mode and a count.
+
+    When received with mode 0 (no NewGRF information), the value is None.
+    When sending, mode 1 (grfid and md5sum only) is always used.
+    """
+
+    def emit_read(self, gen, indent):
+        gen.emit(indent, f"{self.name} = {gen.constant(_read_newgrfs)}(reader)")
+
+    def emit_write(self, gen, indent, value):
+        gen.emit(indent, f"{gen.constant(_write_newgrfs)}(writer, {value})")
+
+
+class Versioned(Field):
+    """
+    A version number, followed by the fields belonging to that version.
+
+    "schemas" maps every known version to its list of fields. This has to
+    be the last field of a packet. The version itself is checked, but not
+    part of the decoded values.
+    """
+
+    def __init__(self, name, schemas, error=None):
+        super().__init__(name, error=error)
+        self.schemas = schemas
+
+
+def _split_runs(fields):
+    """Split the fields in runs of fixed-size fields, and single other fields."""
+
+    run = []
+    for field in fields:
+        if field.format is not None:
+            run.append(field)
+            continue
+
+        if run:
+            yield run
+            run = []
+        yield field
+
+    if run:
+        yield run
+
+
+def _emit_decoder(gen, indent, fields, names):
+    for run in _split_runs(fields):
+        if isinstance(run, Versioned):
+            if run is not fields[-1]:
+                raise ValueError("Versioned has to be the last field")
+
+            gen.emit(indent, f"{run.name} = reader.read_uint8()")
+            for version, sub_fields in run.schemas.items():
+                gen.emit(indent, f"if {run.name} == {version!r}:")
+                _emit_decoder(gen, indent + 1, sub_fields, names)
+            gen.emit(indent, f"raise PacketInvalidData({gen.constant(run.error)}, {run.name})")
+            return
+
+        if isinstance(run, Field):
+            run.emit_read(gen, indent)
+            run = [run]
+        else:
+            s = struct.Struct("<" + "".join(field.format for field in run))
+            gen.emit(indent, f"{''.join(f'{field.name}, ' for field in run)}= reader.read_struct({gen.constant(s)})")
+
+        for field in run:
+            field.emit_check(gen, indent)
+            names = names + [field.name]
+
+    gen.emit(indent, "if reader.remaining() != 0:")
+    gen.emit(indent + 1, 'raise PacketInvalidData("more bytes than expected; remaining: ", reader.remaining())')
+    gen.emit(indent, "return {" + ", ".join(f"{name!r}: {name}" for name in names) + "}")
+
+
+def _emit_encoder(gen, indent, fields, value):
+    for run in _split_runs(fields):
+        if isinstance(run, Versioned):
+            gen.emit(indent, f"writer.write_uint8({value(run)})")
+            for version, sub_fields in run.schemas.items():
+                gen.emit(indent, f"if {value(run)} == {version!r}:")
+                # Fields of a version are taken from the remaining keyword arguments.
+                _emit_encoder(gen, indent + 1, sub_fields, lambda field: f"values[{field.name!r}]")
+        elif isinstance(run, Field):
+            run.emit_write(gen, indent, value(run))
+        else:
+            s = struct.Struct("<" + "".join(field.format for field in run))
+            gen.emit(indent, f"writer += {gen.constant(s.pack)}({', '.join(value(field) for field in run)})")
+
+
+def create_decoder(fields):
+    """
+    Create a decoder for a packet with the given fields.
+
+    The decoder is generated as a single function reading every field in
+    order, with one struct for every run of fixed-size fields. It returns a
+    dict with every field.
+    """
+
+    gen = _Generator()
+    gen.emit(0, "def decoder(source, reader):")
+    _emit_decoder(gen, 1, fields, [])
+    return gen.compile("decoder")
+
+
+def create_encoder(fields, type=None):
+    """
+    Create an encoder for the given fields, taking every field as keyword argument.
+
+    If "type" is given, the encoder returns a complete packet of that type.
+    Otherwise only the encoded fields are returned.
+    """
+
+    gen = _Generator()
+    arguments = "".join(f"{field.name}, " for field in fields)
+    gen.emit(0, f"def encoder(*, {arguments}**values):")
+    gen.emit(1, f"writer = PacketWriter({gen.constant(type)})")
+    _emit_encoder(gen, 1, fields, lambda field: field.name)
+    if type is None:
+        gen.emit(1, "return writer.get_data()")
+    else:
+        gen.emit(1, "return writer.finish()")
+    return gen.compile("encoder")
@@ -4,36 +4,56 @@ from .exceptions import PacketTooBig
 
 SEND_MTU = 32767
 
+_uint8 = struct.Struct("<B")
+_uint16 = struct.Struct("<H")
+_uint32 = struct.Struct("<I")
+_uint64 = struct.Struct("<Q")
 
-def write_init(type):
-    return b"\x00\x00" + struct.pack("<B", type)
 
+class PacketWriter(bytearray):
+    """
+    Builder for a single packet.
 
-def write_uint8(data, value):
-    return data + struct.pack("<B", value)
+    Fields are appended to this bytearray in place, instead of creating a
+    new bytes object for every field. The length of the packet is patched
+    in place once all fields are written.
+    """
 
+    def __init__(self, type=None):
+        if type is None:
+            super().__init__()
+            return
 
-def write_uint16(data, value):
-    return data + struct.pack("<H", value)
+        # Reserve room for the length; it is patched in by finish().
+        super().__init__(b"\x00\x00")
+        self.append(type)
 
+    def write_uint8(self, value):
+        self.append(value)
 
-def write_uint32(data, value):
-    return data + struct.pack("<I", value)
+    def write_uint16(self, value):
+        self += _uint16.pack(value)
 
+    def write_uint32(self, value):
+        self += _uint32.pack(value)
 
-def write_uint64(data, value):
-    return data + struct.pack("<Q", value)
+    def write_uint64(self, value):
+        self += _uint64.pack(value)
 
+    def write_bytes(self, value):
+        self += value
 
-def write_bytes(data, value):
-    return data + value
+    def write_string(self, value):
+        self += value.encode()
+        self.append(0)
 
+    def get_data(self):
+        return bytes(self)
 
-def write_string(data, value):
-    return data + value.encode() + b"\x00"
+    def finish(self):
+        length = len(self)
+        if length > SEND_MTU:
+            raise PacketTooBig(length)
 
-
-def write_presend(data):
-    if len(data) > SEND_MTU:
-        raise PacketTooBig(len(data))
-    return struct.pack("<H", len(data)) + data[2:]
+        _uint16.pack_into(self, 0, length)
+        return self.get_data()
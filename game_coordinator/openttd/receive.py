@@ -1,328 +1,282 @@
+import asyncio
+import click
 import logging
 
+from openttd_helpers import click_helper
+
 from .protocol.enums import (
     PacketTCPCoordinatorType,
     PacketTCPStunType,
     PacketTCPTurnType,
-    ServerGameType,
 )
 from .protocol.exceptions import (
     PacketInvalidData,
     PacketInvalidSize,
     PacketInvalidType,
 )
+from .protocol.packets import (
+    COORDINATOR_PACKETS,
+    STUN_PACKETS,
+    TURN_PACKETS,
+)
 from .protocol.read import (
-    read_bytes,
-    read_string,
-    read_uint8,
-    read_uint16,
-    read_uint32,
+    PacketReader,
+    peek_uint16,
 )
+from .protocol.schema import create_decoder
 
 log = logging.getLogger(__name__)
 
+_dispatch_tables = {}
 
-class OpenTTDProtocolStunReceive:
-    def receive_data(self, queue, data):
-        while len(data) > 2:
-            length, _ = read_uint16(data)
 
-            if len(data) < length:
-                break
+class PacketDispatch:
+    """Decoder and handler of a single packet type, and how often it was received."""
 
-            queue.put_nowait(data[0:length])
-            data = data[length:]
+    __slots__ = ("type", "decoder", "handler", "count")
 
-        return data
+    def __init__(self, type, decoder, handler):
+        self.type = type
+        self.decoder = decoder
+        self.handler = handler
+        self.count = 0
 
-    def receive_packet(self, source, data):
-        # Check length of packet
-        length, data = read_uint16(data)
-        if length != len(data) + 2:
-            raise PacketInvalidSize(len(data) + 2, length)
 
-        # Check if type is in range
-        type, data = read_uint8(data)
-        if type >= PacketTCPStunType.PACKET_STUN_END:
-            raise PacketInvalidType(type)
+def get_dispatch_table(cls, callback, packet_types):
+    """
+    Get the table to dispatch packets received by protocol class "cls" to "callback".
 
-        # Check if we expect this packet
-        type = PacketTCPStunType(type)
-        func = getattr(self, f"receive_{type.name}", None)
-        if func is None:
-            raise PacketInvalidType(type)
-
-        # Process this packet
-        kwargs = func(source, data)
-        return type, kwargs
+    The table is indexed by the raw type of the packet; types that are not
+    expected are None. It is created only once per protocol class and
+    callback.
+    """
 
-    @staticmethod
-    def receive_PACKET_STUN_CLIENT_STUN(source, data):
-        protocol_version, data = read_uint8(data)
+    table = _dispatch_tables.get((cls, callback))
+    if table is not None:
+        return table
 
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", protocol_version)
+    table = [None] * 256
+    for type in packet_types:
+        decoder = getattr(cls, f"receive_{type.name}", None)
+        handler = getattr(callback, f"receive_{type.name}", None)
+        if decoder is None or handler is None:
+            continue
 
-        token, data = read_string(data)
-        interface_number, data = read_uint8(data)
+        table[type] = PacketDispatch(type, decoder, handler)
 
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected; remaining: ", len(data))
+    table = tuple(table)
+    _dispatch_tables[(cls, callback)] = table
+    return table
 
-        return {"interface_number": interface_number, "token": token}
 
+def get_packet_counts():
+    """How often every packet type was received, by all protocols of this process."""
 
-class OpenTTDProtocolTurnReceive:
-    def receive_data(self, queue, data):
-        while len(data) > 2:
-            length, _ = read_uint16(data)
+    counts = {}
+    for table in _dispatch_tables.values():
+        for dispatch in table:
+            if dispatch is not None and dispatch.count:
+                counts[dispatch.type.name] = counts.get(dispatch.type.name, 0) + dispatch.count
+    return counts
 
-            if len(data) < length:
-                break
 
-            queue.put_nowait(data[0:length])
-            data = data[length:]
+class PacketStats:
+    # Seconds between two logs of the packet counts; 0 to disable.
+    interval = 0
+    _task = None
 
-        return data
+    @classmethod
+    def start(cls):
+        if cls._task is None and cls.interval:
+            cls._task = asyncio.get_event_loop().create_task(cls._log())
 
-    def receive_packet(self, source, data):
-        # Check length of packet
-        length, data = read_uint16(data)
-        if length != len(data) + 2:
-            raise PacketInvalidSize(len(data) + 2, length)
+    @classmethod
+    async def _log(cls):
+        counts = get_packet_counts()
 
-        # Check if type is in range
-        type, data = read_uint8(data)
-        if type >= PacketTCPTurnType.PACKET_TURN_END:
-            raise PacketInvalidType(type)
+        while True:
+            await asyncio.sleep(cls.interval)
 
-        # Check if we expect this packet
-        type = PacketTCPTurnType(type)
-        func = getattr(self, f"receive_{type.name}", None)
-        if func is None:
-            raise PacketInvalidType(type)
+            # Totals since start, and (between brackets) since the last log.
+            last_counts, counts = counts, get_packet_counts()
+            stats = ", ".join(
+                f"{name[7:]} {count} (+{count - last_counts.get(name, 0)})" for name, count in sorted(counts.items())
+            )
+            log.info(f"Packet stats: {stats or 'nothing received'}")
 
-        # Process this packet
-        kwargs = func(source, data)
-        return type, kwargs
 
-    @staticmethod
-    def receive_PACKET_TURN_CLIENT_CONNECT(source, data):
-        protocol_version, data = read_uint8(data)
+def _decoder(packets, type):
+    return staticmethod(create_decoder(packets[type]))
 
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", protocol_version)
 
-        token, data = read_string(data)
+_decode_PACKET_COORDINATOR_CLIENT_UPDATE = create_decoder(
+    COORDINATOR_PACKETS[PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_UPDATE]
+)
 
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected; remaining: ", len(data))
 
-        return {"token": token}
+class OpenTTDProtocolStunReceive:
+    def get_dispatch_table(self, callback):
+        return get_dispatch_table(self.__class__, callback, PacketTCPStunType)
 
+    def receive_data(self, dispatch, data, start, end):
+        while end - start > 2:
+            length = peek_uint16(data, start)
 
-class OpenTTDProtocolCoordinatorReceive:
-    def receive_data(self, queue, data):
-        while len(data) > 2:
-            length, _ = read_uint16(data)
+            # Every packet has at least a length and a type.
+            if length < 3:
+                raise PacketInvalidSize(length)
 
-            if len(data) < length:
+            if end - start < length:
                 break
 
-            queue.put_nowait(data[0:length])
-            data = data[length:]
+            dispatch(data, start, start + length)
+            start += length
 
-        return data
+        return start
 
-    def receive_packet(self, source, data):
-        # Check length of packet
-        length, data = read_uint16(data)
-        if length != len(data) + 2:
-            raise PacketInvalidSize(len(data) + 2, length)
+    def receive_packet(self, source, data, start=0, end=None):
+        reader = PacketReader(data, start, end)
 
-        # Check if type is in range
-        type, data = read_uint8(data)
-        if type >= PacketTCPCoordinatorType.PACKET_COORDINATOR_END:
-            raise PacketInvalidType(type)
+        # Check length of packet
+        length = reader.read_uint16()
+        if length != reader.remaining() + 2:
+            raise PacketInvalidSize(reader.remaining() + 2, length)
 
         # Check if we expect this packet
-        type = PacketTCPCoordinatorType(type)
-        func = getattr(self, f"receive_{type.name}", None)
-        if func is None:
+        type = reader.read_uint8()
+        dispatch = self._dispatch_table[type]
+        if dispatch is None:
             raise PacketInvalidType(type)
 
         # Process this packet
-        kwargs = func(source, data)
-        return type, kwargs
+        dispatch.count += 1
+        kwargs = dispatch.decoder(source, reader)
+        return dispatch, kwargs
 
-    @staticmethod
-    def receive_PACKET_COORDINATOR_CLIENT_REGISTER(source, data):
-        protocol_version, data = read_uint8(data)
+    receive_PACKET_STUN_CLIENT_STUN = _decoder(STUN_PACKETS, PacketTCPStunType.PACKET_STUN_CLIENT_STUN)
 
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", protocol_version)
 
-        game_type, data = read_uint8(data)
+class OpenTTDProtocolTurnReceive:
+    def get_dispatch_table(self, callback):
+        return get_dispatch_table(self.__class__, callback, PacketTCPTurnType)
 
-        if game_type >= ServerGameType.SERVER_GAME_TYPE_END:
-            raise PacketInvalidData("invalid ServerGameType", game_type)
+    def receive_data(self, dispatch, data, start, end):
+        while end - start > 2:
+            length = peek_uint16(data, start)
 
-        game_type = ServerGameType(game_type)
+            # Every packet has at least a length and a type.
+            if length < 3:
+                raise PacketInvalidSize(length)
 
-        server_port, data = read_uint16(data)
+            if end - start < length:
+                break
 
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected; remaining: ", len(data))
+            dispatch(data, start, start + length)
+            start += length
 
-        return {"protocol_version": protocol_version, "game_type": game_type, "server_port": server_port}
+        return start
 
-    @staticmethod
-    def receive_PACKET_COORDINATOR_CLIENT_UPDATE(source, data):
-        protocol_version, data = read_uint8(data)
-
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", protocol_version)
-
-        game_info_version, data = read_uint8(data)
-
-        if game_info_version != 5:
-            raise PacketInvalidData("unknown game info version: ", game_info_version)
-
-        join_key, data = read_string(data)
-
-        if getattr(source, "join_key", None) != join_key:
-            raise PacketInvalidData("join_key doesn't match registration: ", getattr(source, "join_key"), join_key)
-
-        newgrf_mode, data = read_uint8(data)
-        if newgrf_mode == 0:
-            newgrfs = None
-        else:
-            newgrf_count, data = read_uint8(data)
-
-            newgrfs = []
-            for i in range(newgrf_count):
-                newgrf_id, data = read_uint32(data)
-                md5sum, data = read_bytes(data, 16)
-
-                # Servers shouldn't be sending this, but we accept and ignore it.
-                # This is just to be protocol compatible.
-                if newgrf_mode == 2:
-                    _, data = read_string(data)
-
-                newgrfs.append((newgrf_id, md5sum))
-
-        game_date, data = read_uint32(data)
-        start_date, data = read_uint32(data)
-
-        companies_max, data = read_uint8(data)
-        companies_on, data = read_uint8(data)
-        spectators_max, data = read_uint8(data)
-
-        name, data = read_string(data)
-        openttd_version, data = read_string(data)
-        use_password, data = read_uint8(data)
-
-        clients_max, data = read_uint8(data)
-        clients_on, data = read_uint8(data)
-        spectators_on, data = read_uint8(data)
-
-        map_width, data = read_uint16(data)
-        map_height, data = read_uint16(data)
-        map_type, data = read_uint8(data)
-
-        is_dedicated, data = read_uint8(data)
-
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected; remaining: ", len(data))
-
-        return {
-            "protocol_version": protocol_version,
-            "join_key": join_key,
-            "newgrfs": newgrfs,
-            "game_date": game_date,
-            "start_date": start_date,
-            "companies_max": companies_max,
-            "companies_on": companies_on,
-            "clients_max": clients_max,
-            "clients_on": clients_on,
-            "spectators_max": spectators_max,
-            "spectators_on": spectators_on,
-            "name": name,
-            "openttd_version": openttd_version,
-            "use_password": use_password,
-            "is_dedicated": is_dedicated,
-            "map_width": map_width,
-            "map_height": map_height,
-            "map_type": map_type,
-        }
+    def receive_packet(self, source, data, start=0, end=None):
+        reader = PacketReader(data, start, end)
 
-    @staticmethod
-    def receive_PACKET_COORDINATOR_CLIENT_LISTING(source, data):
-        protocol_version, data = read_uint8(data)
-
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", len(protocol_version))
-
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected; remaining: ", len(data))
+        # Check length of packet
+        length = reader.read_uint16()
+        if length != reader.remaining() + 2:
+            raise PacketInvalidSize(reader.remaining() + 2, length)
 
-        return {"protocol_version": protocol_version}
+        # Check if we expect this packet
+        type = reader.read_uint8()
+        dispatch = self._dispatch_table[type]
+        if dispatch is None:
+            raise PacketInvalidType(type)
 
-    @staticmethod
-    def receive_PACKET_COORDINATOR_CLIENT_CONNECT(source, data):
-        protocol_version, data = read_uint8(data)
+        # Process this packet
+        dispatch.count += 1
+        kwargs = dispatch.decoder(source, reader)
+        return dispatch, kwargs
 
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", len(protocol_version))
+    receive_PACKET_TURN_CLIENT_CONNECT = _decoder(TURN_PACKETS, PacketTCPTurnType.PACKET_TURN_CLIENT_CONNECT)
+    receive_PACKET_TURN_CLIENT_STATS = _decoder(TURN_PACKETS, PacketTCPTurnType.PACKET_TURN_CLIENT_STATS)
 
-        join_key, data = read_string(data)
 
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected; remaining: ", len(data))
+class OpenTTDProtocolCoordinatorReceive:
+    def get_dispatch_table(self, callback):
+        return get_dispatch_table(self.__class__, callback, PacketTCPCoordinatorType)
 
-        return {"protocol_version": protocol_version, "join_key": join_key}
+    def receive_data(self, dispatch, data, start, end):
+        while end - start > 2:
+            length = peek_uint16(data, start)
 
-    @staticmethod
-    def receive_PACKET_COORDINATOR_CLIENT_CONNECT_FAILED(source, data):
-        protocol_version, data = read_uint8(data)
+            # Every packet has at least a length and a type.
+            if length < 3:
+                raise PacketInvalidSize(length)
 
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", len(protocol_version))
-
-        token, data = read_string(data)
-        tracking_number, data = read_uint8(data)
+            if end - start < length:
+                break
 
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected; remaining: ", len(data))
+            dispatch(data, start, start + length)
+            start += length
 
-        return {"protocol_version": protocol_version, "token": token, "tracking_number": tracking_number}
+        return start
 
-    @staticmethod
-    def receive_PACKET_COORDINATOR_CLIENT_CONNECTED(source, data):
-        protocol_version, data = read_uint8(data)
+    def receive_packet(self, source, data, start=0, end=None):
+        reader = PacketReader(data, start, end)
 
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", len(protocol_version))
+        # Check length of packet
+        length = reader.read_uint16()
+        if length != reader.remaining() + 2:
+            raise PacketInvalidSize(reader.remaining() + 2, length)
 
-        token, data = read_string(data)
+        # Check if we expect this packet
+        type = reader.read_uint8()
+        dispatch = self._dispatch_table[type]
+        if dispatch is None:
+            raise PacketInvalidType(type)
 
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected2; remaining: ", len(data))
+        # Process this packet
+        dispatch.count += 1
+        kwargs = dispatch.decoder(source, reader)
+        return dispatch, kwargs
 
-        return {"protocol_version": protocol_version, "token": token}
+    receive_PACKET_COORDINATOR_CLIENT_REGISTER = _decoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_REGISTER
+    )
 
     @staticmethod
-    def receive_PACKET_COORDINATOR_CLIENT_STUN_RESULT(source, data):
-        protocol_version, data = read_uint8(data)
-
-        if protocol_version != 1:
-            raise PacketInvalidData("unknown protocol version: ", len(protocol_version))
-
-        token, data = read_string(data)
-        family, data = read_uint8(data)
-        result, data = read_uint8(data)
-
-        if len(data) != 0:
-            raise PacketInvalidData("more bytes than expected2; remaining: ", len(data))
-
-        return {"protocol_version": protocol_version, "token": token, "family": family, "result": result}
+    def receive_PACKET_COORDINATOR_CLIENT_UPDATE(source, reader):
+        kwargs = _decode_PACKET_COORDINATOR_CLIENT_UPDATE(source, reader)
+
+        if getattr(source, "join_key", None) != kwargs["join_key"]:
+            raise PacketInvalidData(
+                "join_key doesn't match registration: ", getattr(source, "join_key", None), kwargs["join_key"]
+            )
+
+        return kwargs
+
+    receive_PACKET_COORDINATOR_CLIENT_LISTING = _decoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_LISTING
+    )
+    receive_PACKET_COORDINATOR_CLIENT_CONNECT = _decoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECT
+    )
+    receive_PACKET_COORDINATOR_CLIENT_CONNECT_FAILED = _decoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECT_FAILED
+    )
+    receive_PACKET_COORDINATOR_CLIENT_CONNECTED = _decoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_CONNECTED
+    )
+    receive_PACKET_COORDINATOR_CLIENT_STUN_RESULT = _decoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_CLIENT_STUN_RESULT
+    )
+
+
+@click_helper.extend
+@click.option(
+    "--packet-stats-interval",
+    help="Seconds between two logs of how often every packet type was received (0 to disable).",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+def click_packet_stats_interval(packet_stats_interval):
+    PacketStats.interval = packet_stats_interval
@@ -3,151 +3,172 @@ from .protocol.enums import (
     PacketTCPTurnType,
     ServerGameType,
 )
+from .protocol.packets import (
+    COORDINATOR_PACKETS,
+    GAME_INFO,
+    TURN_PACKETS,
+)
+from .protocol.schema import create_encoder
 from .protocol.write import (
-    write_init,
-    write_bytes,
-    write_string,
-    write_uint8,
-    write_uint16,
-    write_uint32,
-    write_presend,
+    SEND_MTU,
+    PacketWriter,
 )
 
 
-class OpenTTDProtocolTurnSend:
-    async def send_PACKET_TURN_SERVER_CONNECTED(self, host, port):
-        data = write_init(PacketTCPTurnType.PACKET_TURN_SERVER_CONNECTED)
-
-        data = write_string(data, host)
-        data = write_uint16(data, port)
-
-        data = write_presend(data)
-        await self.send_packet(data)
-
-
-class OpenTTDProtocolCoordinatorSend:
-    async def send_PACKET_COORDINATOR_SERVER_ERROR(self, error_no, error_detail):
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_ERROR)
-
-        data = write_uint8(data, error_no.value)
-        data = write_string(data, error_detail)
+def _encoder(packets, type):
+    return staticmethod(create_encoder(packets[type], type))
 
-        data = write_presend(data)
-        await self.send_packet(data)
 
-    async def send_PACKET_COORDINATOR_SERVER_REGISTER_ACK(self, join_key, connection_type):
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_REGISTER_ACK)
-
-        data = write_string(data, join_key)
-        data = write_uint8(data, connection_type.value)
-
-        data = write_presend(data)
-        await self.send_packet(data)
-
-    async def send_PACKET_COORDINATOR_SERVER_LISTING(self, servers):
-        for join_key, server in servers.items():
-            if server.game_type != ServerGameType.SERVER_GAME_TYPE_PUBLIC:
-                continue
-            if len(server.info) == 0:
-                continue
-
-            data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_LISTING)
-
-            data = write_uint16(data, 1)
-
-            data = write_uint8(data, 5)  # Game Info version
-            data = write_string(data, join_key)
-            data = write_uint8(data, 1)  # has-newgrf-data
-
-            data = write_uint8(data, len(server.info["newgrfs"]))
-            for newgrf in server.info["newgrfs"]:
-                data = write_uint32(data, newgrf[0])
-                data = write_bytes(data, newgrf[1])
-
-            data = write_uint32(data, server.info["game_date"])
-            data = write_uint32(data, server.info["start_date"])
-
-            data = write_uint8(data, server.info["companies_max"])
-            data = write_uint8(data, server.info["companies_on"])
-            data = write_uint8(data, server.info["spectators_max"])
+class OpenTTDProtocolTurnSend:
+    _encode_PACKET_TURN_SERVER_CONNECTED = _encoder(TURN_PACKETS, PacketTCPTurnType.PACKET_TURN_SERVER_CONNECTED)
 
-            data = write_string(data, server.info["name"])
-            data = write_string(data, server.info["openttd_version"])
-            data = write_uint8(data, server.info["use_password"])
-            data = write_uint8(data, server.info["clients_max"])
-            data = write_uint8(data, server.info["clients_on"])
-            data = write_uint8(data, server.info["spectators_on"])
+    async def send_PACKET_TURN_SERVER_CONNECTED(self, host, port):
+        await self.send_packet(self._encode_PACKET_TURN_SERVER_CONNECTED(host=host, port=port))
 
-            data = write_uint16(data, server.info["map_width"])
-            data = write_uint16(data, server.info["map_height"])
-            data = write_uint8(data, server.info["map_type"])
+    _encode_PACKET_TURN_SERVER_STATS = _encoder(TURN_PACKETS, PacketTCPTurnType.PACKET_TURN_SERVER_STATS)
 
-            data = write_uint8(data, server.info["is_dedicated"])
+    async def send_PACKET_TURN_SERVER_STATS(self, relays, bytes_per_sec):
+        await self.send_packet(self._encode_PACKET_TURN_SERVER_STATS(relays=relays, bytes_per_sec=bytes_per_sec))
 
-            data = write_presend(data)
-            await self.send_packet(data)
 
-        # Send a final packet with 0 servers to indicate end-of-list.
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_LISTING)
-        data = write_uint16(data, 0)
-        data = write_presend(data)
-        await self.send_packet(data)
+class OpenTTDProtocolCoordinatorSend:
+    """
+    Packets are sent without waiting for the write buffer to drain; see
+    send_packet_nowait(). Only the server listing waits, as it can be many
+    packets long.
+    """
 
-    async def send_PACKET_COORDINATOR_SERVER_CONNECTING(self, token, join_key):
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_CONNECTING)
+    _encode_PACKET_COORDINATOR_SERVER_ERROR = _encoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_ERROR
+    )
 
-        data = write_string(data, token)
-        data = write_string(data, join_key)
+    def send_PACKET_COORDINATOR_SERVER_ERROR(self, error_no, error_detail):
+        self.send_packet_nowait(
+            self._encode_PACKET_COORDINATOR_SERVER_ERROR(error_no=error_no, error_detail=error_detail)
+        )
 
-        data = write_presend(data)
-        await self.send_packet(data)
+    _encode_PACKET_COORDINATOR_SERVER_REGISTER_ACK = _encoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_REGISTER_ACK
+    )
 
-    async def send_PACKET_COORDINATOR_SERVER_CONNECT_FAILED(self, token):
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_CONNECT_FAILED)
+    def send_PACKET_COORDINATOR_SERVER_REGISTER_ACK(self, join_key, connection_type):
+        self.send_packet_nowait(
+            self._encode_PACKET_COORDINATOR_SERVER_REGISTER_ACK(join_key=join_key, connection_type=connection_type)
+        )
 
-        data = write_string(data, token)
+    _encode_game_info = staticmethod(create_encoder((GAME_INFO,)))
 
-        data = write_presend(data)
-        await self.send_packet(data)
+    @classmethod
+    def _encode_server_listing_entry(cls, join_key, info):
+        return cls._encode_game_info(**dict(info, join_key=join_key, game_info_version=5))
 
-    async def send_PACKET_COORDINATOR_SERVER_DIRECT_CONNECT(self, token, tracking_number, server_host, server_port):
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_DIRECT_CONNECT)
+    @staticmethod
+    def _encode_PACKET_COORDINATOR_SERVER_LISTING(entries):
+        packet = PacketWriter(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_LISTING)
 
-        data = write_string(data, token)
-        data = write_uint8(data, tracking_number)
-        data = write_string(data, server_host)
-        data = write_uint16(data, server_port)
+        packet.write_uint16(len(entries))
+        for entry in entries:
+            packet.write_bytes(entry)
 
-        data = write_presend(data)
-        await self.send_packet(data)
+        return packet.finish()
 
-    async def send_PACKET_COORDINATOR_SERVER_STUN_REQUEST(self, token):
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_STUN_REQUEST)
+    @classmethod
+    def encode_server_listing(cls, servers):
+        """
+        Encode the listing of all public servers.
 
-        data = write_string(data, token)
+        The result is a tuple of ready-to-send packets, which can be shared
+        between all clients requesting the listing.
+        """
 
-        data = write_presend(data)
-        await self.send_packet(data)
+        packets = []
+        entries = []
+        # Packet header (length + type) plus the amount of servers.
+        size = 5
 
-    async def send_PACKET_COORDINATOR_SERVER_STUN_CONNECT(self, token, tracking_number, interface_number, host, port):
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_STUN_CONNECT)
+        for join_key, server in servers.items():
+            if server.game_type != ServerGameType.SERVER_GAME_TYPE_PUBLIC:
+                continue
+            if len(server.info) == 0:
+                continue
 
-        data = write_string(data, token)
-        data = write_uint8(data, tracking_number)
-        data = write_uint8(data, interface_number)
-        data = write_string(data, host)
-        data = write_uint16(data, port)
+            # The entry only changes when the server sends an update, so it
+            # is encoded once and reused for every listing.
+            if server.listing_entry is None:
+                server.listing_entry = cls._encode_server_listing_entry(join_key, server.info)
 
-        data = write_presend(data)
-        await self.send_packet(data)
+            # Fill every packet with as many servers as fit in it.
+            if entries and size + len(server.listing_entry) > SEND_MTU:
+                packets.append(cls._encode_PACKET_COORDINATOR_SERVER_LISTING(entries))
+                entries = []
+                size = 5
 
-    async def send_PACKET_COORDINATOR_SERVER_TURN_CONNECT(self, token, tracking_number, host, port):
-        data = write_init(PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_TURN_CONNECT)
+            entries.append(server.listing_entry)
+            size += len(server.listing_entry)
 
-        data = write_string(data, token)
-        data = write_uint8(data, tracking_number)
-        data = write_string(data, host)
-        data = write_uint16(data, port)
+        if entries:
+            packets.append(cls._encode_PACKET_COORDINATOR_SERVER_LISTING(entries))
 
-        data = write_presend(data)
-        await self.send_packet(data)
+        # Send a final packet with 0 servers to indicate end-of-list.
+        packets.append(cls._encode_PACKET_COORDINATOR_SERVER_LISTING([]))
+
+        return tuple(packets)
+
+    async def send_PACKET_COORDINATOR_SERVER_LISTING(self, listing):
+        # A listing can be many packets; let the write buffer drain in between.
+        for packet in listing:
+            await self.send_packet(packet)
+
+    _encode_PACKET_COORDINATOR_SERVER_CONNECTING = _encoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_CONNECTING
+    )
+
+    def send_PACKET_COORDINATOR_SERVER_CONNECTING(self, token, join_key):
+        self.send_packet_nowait(self._encode_PACKET_COORDINATOR_SERVER_CONNECTING(token=token, join_key=join_key))
+
+    _encode_PACKET_COORDINATOR_SERVER_CONNECT_FAILED = _encoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_CONNECT_FAILED
+    )
+
+    def send_PACKET_COORDINATOR_SERVER_CONNECT_FAILED(self, token):
+        self.send_packet_nowait(self._encode_PACKET_COORDINATOR_SERVER_CONNECT_FAILED(token=token))
+
+    _encode_PACKET_COORDINATOR_SERVER_DIRECT_CONNECT = _encoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_DIRECT_CONNECT
+    )
+
+    def send_PACKET_COORDINATOR_SERVER_DIRECT_CONNECT(self, token, tracking_number, server_host, server_port):
+        self.send_packet_nowait(
+            self._encode_PACKET_COORDINATOR_SERVER_DIRECT_CONNECT(
+                token=token, tracking_number=tracking_number, server_host=server_host, server_port=server_port
+            )
+        )
+
+    _encode_PACKET_COORDINATOR_SERVER_STUN_REQUEST = _encoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_STUN_REQUEST
+    )
+
+    def send_PACKET_COORDINATOR_SERVER_STUN_REQUEST(self, token):
+        self.send_packet_nowait(self._encode_PACKET_COORDINATOR_SERVER_STUN_REQUEST(token=token))
+
+    _encode_PACKET_COORDINATOR_SERVER_STUN_CONNECT = _encoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_STUN_CONNECT
+    )
+
+    def send_PACKET_COORDINATOR_SERVER_STUN_CONNECT(self, token, tracking_number, interface_number, host, port):
+        self.send_packet_nowait(
+            self._encode_PACKET_COORDINATOR_SERVER_STUN_CONNECT(
+                token=token, tracking_number=tracking_number, interface_number=interface_number, host=host, port=port
+            )
+        )
+
+    _encode_PACKET_COORDINATOR_SERVER_TURN_CONNECT = _encoder(
+        COORDINATOR_PACKETS, PacketTCPCoordinatorType.PACKET_COORDINATOR_SERVER_TURN_CONNECT
+    )
+
+    def send_PACKET_COORDINATOR_SERVER_TURN_CONNECT(self, token, tracking_number, host, port):
+        self.send_packet_nowait(
+            self._encode_PACKET_COORDINATOR_SERVER_TURN_CONNECT(
+                token=token, tracking_number=tracking_number, host=host, port=port
+            )
+        )
@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import time
+
+# Rates for monitoring are averaged over at least this many seconds.
+RATE_INTERVAL = 5
+
+
+class TokenBucket:
+    """
+    Allow "rate" bytes per second, with bursts of up to a second worth.
+
+    Bytes are always taken, even if this puts the bucket in debt; the caller
+    is expected to stop reading till the debt is paid off. A rate of 0 means
+    unlimited; the bucket then only measures the rate for monitoring.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.bytes = 0
+
+        now = time.monotonic()
+        self._updated = now
+        self._rate_at = now
+        self._rate_bytes = 0
+        self._rate = 0
+
+    def refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, nbytes, now):
+        """Take nbytes from the bucket, and return how many seconds it takes to pay off the debt, if any."""
+
+        self.bytes += nbytes
+        if not self.rate:
+            return 0
+
+        self.refill(now)
+        self.tokens -= nbytes
+        return self.get_delay()
+
+    def get_delay(self):
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def get_rate(self, now):
+        if now - self._rate_at >= RATE_INTERVAL:
+            self._rate = (self.bytes - self._rate_bytes) / (now - self._rate_at)
+            self._rate_at = now
+            self._rate_bytes = self.bytes
+        return self._rate
+
+
+class Shaper:
+    """
+    Shape the bandwidth of relays, with a token bucket for every relay, for
+    every source IP, and one for all relays together.
+
+    A relay over its own limit, or the limit of its IP, stops reading till
+    its debt is paid off. If all relays together are over the limit, the
+    relays stop reading and queue up; once there is bandwidth again, they
+    are resumed in the order they queued up, for a single read each. This
+    way every relay gets its fair share, no matter how much it sends.
+    """
+
+    def __init__(self, relay_rate=0, ip_rate=0, total_rate=0):
+        self.relay_rate = relay_rate
+        self.ip_rate = ip_rate
+        self.total = TokenBucket(total_rate)
+
+        self._ips = {}
+        self._waiting = collections.deque()
+        self._timer = None
+
+    def is_shaping(self):
+        return bool(self.relay_rate or self.ip_rate or self.total.rate)
+
+    def create_relay_bucket(self):
+        return TokenBucket(self.relay_rate)
+
+    def acquire_ip_bucket(self, ip):
+        entry = self._ips.get(ip)
+        if entry is None:
+            entry = [TokenBucket(self.ip_rate), 0]
+            self._ips[ip] = entry
+
+        entry[1] += 1
+        return entry[0]
+
+    def release_ip_bucket(self, ip):
+        entry = self._ips[ip]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._ips[ip]
+
+    def take(self, protocol, nbytes):
+        now = time.monotonic()
+
+        delay = max(protocol.relay_bucket.take(nbytes, now), protocol.ip_bucket.take(nbytes, now))
+        if delay:
+            protocol.throttle(delay)
+
+        if self.total.take(nbytes, now) and not protocol.is_reading_paused("total"):
+            protocol.pause_reading("total")
+            self._waiting.append(protocol)
+            self._schedule(self.total.get_delay())
+
+    def get_rates(self):
+        now = time.monotonic()
+        return {
+            "total": self.total.get_rate(now),
+            "ips": {ip: bucket.get_rate(now) for ip, (bucket, _) in self._ips.items()},
+        }
+
+    def _schedule(self, delay):
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(delay, self._release)
+
+    def _release(self):
+        self._timer = None
+
+        # Resume as many relays as there is bandwidth for; every relay is
+        # expected to read at most a full relay buffer.
+        self.total.refill(time.monotonic())
+        budget = self.total.tokens
+        while self._waiting and budget > 0:
+            protocol = self._waiting.popleft()
+            if protocol.transport.is_closing():
+                continue
+
+            protocol.resume_reading("total")
+            budget -= protocol.get_relay_buffer_size()
+
+        if self._waiting:
+            self._schedule(max(-budget, 0) / self.total.rate)
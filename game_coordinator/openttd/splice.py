@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# How many bytes to move per splice() call.
+SPLICE_CHUNK_SIZE = 65536
+
+
+def is_splice_available():
+    return hasattr(os, "splice")
+
+
+class _SpliceDirection:
+    """
+    Moves the data of one side of a relay to the other, socket -> pipe ->
+    socket, without the data ever entering Python.
+    """
+
+    def __init__(self, relay, source, destination):
+        self._relay = relay
+        self._loop = relay.loop
+        self._source = source
+
+        # asyncio doesn't allow adding readers/writers for sockets owned by
+        # a transport; duplicating the file descriptor works around this.
+        self._source_fd = os.dup(source.transport.get_extra_info("socket").fileno())
+        self._destination_fd = os.dup(destination.transport.get_extra_info("socket").fileno())
+        self._pipe_read, self._pipe_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._in_pipe = 0
+
+    def start(self):
+        self._loop.add_reader(self._source_fd, self._on_readable)
+
+    def stop(self):
+        self._loop.remove_reader(self._source_fd)
+        self._loop.remove_writer(self._destination_fd)
+
+        for fd in (self._source_fd, self._destination_fd, self._pipe_read, self._pipe_write):
+            os.close(fd)
+
+    def _on_readable(self):
+        try:
+            length = os.splice(
+                self._source_fd, self._pipe_write, SPLICE_CHUNK_SIZE, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+            )
+        except BlockingIOError:
+            return
+        except OSError as err:
+            self._relay.close(f"reading failed: {err}")
+            return
+
+        if length == 0:
+            self._relay.close("connection closed")
+            return
+
+        self._source.relay_bytes += length
+        self._in_pipe += length
+        self._flush()
+
+    def _on_writable(self):
+        self._flush()
+
+    def _flush(self):
+        while self._in_pipe:
+            try:
+                length = os.splice(
+                    self._pipe_read,
+                    self._destination_fd,
+                    self._in_pipe,
+                    flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+                )
+            except BlockingIOError:
+                # The destination can't keep up; stop reading till it can.
+                self._loop.remove_reader(self._source_fd)
+                self._loop.add_writer(self._destination_fd, self._on_writable)
+                return
+            except OSError as err:
+                self._relay.close(f"writing failed: {err}")
+                return
+
+            self._in_pipe -= length
+
+        if self._loop.remove_writer(self._destination_fd):
+            self._loop.add_reader(self._source_fd, self._on_readable)
+
+
+class SpliceRelay:
+    """
+    Forward a paired relay in the kernel, with os.splice().
+
+    Both transports are paused, and their sockets are read from and written
+    to directly. The relay ends when either side closes or errors; in which
+    case both transports are closed.
+    """
+
+    def __init__(self, left, right):
+        self.loop = asyncio.get_event_loop()
+        self._protocols = (left, right)
+        self._directions = (_SpliceDirection(self, left, right), _SpliceDirection(self, right, left))
+        self._stopped = False
+
+    def start(self):
+        for protocol in self._protocols:
+            protocol.transport.pause_reading()
+        for direction in self._directions:
+            direction.start()
+
+    def stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+
+        for direction in self._directions:
+            direction.stop()
+
+    def close(self, reason):
+        log.debug("Closing spliced relay: %s", reason)
+
+        # Our duplicates of the sockets have to be closed first, otherwise
+        # the connections stay open after the transports are closed.
+        self.stop()
+        for protocol in self._protocols:
+            protocol.transport.close()
@@ -1,5 +1,6 @@
 import asyncio
 import click
+import collections
 import logging
 
 from asyncio.coroutines import iscoroutine
@@ -9,32 +10,42 @@ from .protocol.exceptions import (
     PacketInvalid,
     SocketClosed,
 )
+from .protocol.read import (
+    RECEIVE_BUFFER_SIZE,
+    peek_uint16,
+)
 from .protocol.source import Source
 from .protocol.write import SEND_MTU
 from .receive import OpenTTDProtocolStunReceive
+from .timer_wheel import timer_wheel
 
 log = logging.getLogger(__name__)
 
+# Seconds between two checks whether a connection that can't be written to is closing.
+CHECK_CLOSED_INTERVAL = 5
+
 
-class OpenTTDProtocolTCPStun(asyncio.Protocol, OpenTTDProtocolStunReceive):
+class OpenTTDProtocolTCPStun(asyncio.BufferedProtocol, OpenTTDProtocolStunReceive):
     proxy_protocol = False
+    # The STUN server never sends anything; there is no need for a deep buffer.
+    write_buffer_limits = (SEND_MTU * 2, SEND_MTU)
 
     def __init__(self, callback_class):
         super().__init__()
 
         self._callback = callback_class
-        self._queue = asyncio.Queue()
-        self._data = b""
+        self._dispatch_table = self.get_dispatch_table(callback_class)
+        self._pending = None
+        self._buffer = None
+        self._buffer_start = 0
+        self._buffer_end = 0
         self.new_connection = True
 
-        self.task = asyncio.create_task(self._process_queue())
+        self.task = None
 
     def connection_made(self, transport):
         self.transport = transport
-        # Have a buffer of several packets, after which we expect it to drain to
-        # nearly empty before we start sending again. This reduces the memory
-        # this application uses drasticly on slow connections.
-        self.transport.set_write_buffer_limits(SEND_MTU * 5, SEND_MTU * 2)
+        self.transport.set_write_buffer_limits(*self.write_buffer_limits)
 
         self._can_write = asyncio.Event()
         self._can_write.set()
@@ -43,81 +54,150 @@ class OpenTTDProtocolTCPStun(asyncio.Protocol, OpenTTDProtocolStunReceive):
         self.source = Source(self, socket_addr, socket_addr[0], socket_addr[1])
 
     def connection_lost(self, exc):
-        self.task.cancel()
+        if self.task:
+            self.task.cancel()
+
+    def _check_closed(self):
+        # Asyncio doesn't notify us when the connection is closing, only
+        # when it is closed. Being in pause-writing means we have stuff
+        # in the buffer the client is not receiving. In asyncio language
+        # this means the transport is closing, but not closed. As such,
+        # we receive no "connection_lost" callback. Force this by resuming
+        # write operations, and on the next write it will trigger a
+        # SocketClosed exception, which triggers an abort() on the
+        # transport, releasing our resources. Yes. It is that complicated.
+        if self.transport.is_closing():
+            self._can_write.set()
+            return
 
-    async def _check_closed(self):
-        while True:
-            # Asyncio doesn't notify us when the connection is closing, only
-            # when it is closed. Being in pause-writing means we have stuff
-            # in the buffer the client is not receiving. In asyncio language
-            # this means the transport is closing, but not closed. As such,
-            # we receive no "connection_lost" callback. Force this by resuming
-            # write operations, and on the next write it will trigger a
-            # SocketClosed exception, which triggers an abort() on the
-            # transport, releasing our resources. Yes. It is that complicated.
-            await asyncio.sleep(5)
-            if self.transport.is_closing():
-                self._can_write.set()
-                return
+        self._pause_timer = timer_wheel.call_later(CHECK_CLOSED_INTERVAL, self._check_closed)
 
     def pause_writing(self):
-        self._pause_task = asyncio.create_task(self._check_closed())
+        self._pause_timer = timer_wheel.call_later(CHECK_CLOSED_INTERVAL, self._check_closed)
         self._can_write.clear()
 
     def resume_writing(self):
-        self._pause_task.cancel()
+        self._pause_timer.cancel()
         self._can_write.set()
 
     def _detect_source_ip_port(self, data):
         if not self.proxy_protocol:
-            return data
+            return 0
 
         # If enabled, expect new connections to start with PROXY. In this
         # header is the original source of the connection.
         if data[0:5] != b"PROXY":
             log.warning("Receive data without a proxy protocol header from %s:%d", self.source.ip, self.source.port)
-            return data
+            return 0
 
         # This message arrived via the proxy protocol; use the information
         # from this to figure out the real ip and port.
         proxy_end = data.find(b"\r\n")
         proxy = data[0:proxy_end].decode()
-        data = data[proxy_end + 2 :]
 
         # Example how 'proxy' looks:
         #  PROXY TCP4 127.0.0.1 127.0.0.1 33487 12345
 
         (_, _, ip, _, port, _) = proxy.split(" ")
         self.source = Source(self, self.source.addr, ip, int(port))
-        return data
+        return proxy_end + 2
 
-    def data_received(self, data):
-        if self.new_connection:
-            data = self._detect_source_ip_port(data)
-            self.new_connection = False
+    def get_buffer(self, sizehint):
+        if self._buffer is None:
+            self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
 
-        self._data = self.receive_data(self._queue, self._data + data)
+        # Move what is left of a partial packet to the front of the buffer.
+        if self._buffer_start:
+            length = self._buffer_end - self._buffer_start
+            self._buffer[0:length] = self._buffer[self._buffer_start : self._buffer_end]
+            self._buffer_start = 0
+            self._buffer_end = length
 
-    async def _process_queue(self):
-        while True:
-            data = await self._queue.get()
+        # Make sure the remainder of the packet fits in the buffer.
+        size = len(self._buffer)
+        if self._buffer_end >= 2:
+            size = max(size, peek_uint16(self._buffer))
+        if self._buffer_end == size:
+            size += RECEIVE_BUFFER_SIZE
+        if size > len(self._buffer):
+            self._buffer.extend(bytes(size - len(self._buffer)))
 
-            try:
-                type, kwargs = self.receive_packet(self.source, data)
-            except asyncio.CancelledError:
-                # We were cancelled, meaning the connection was lost.
-                return
-            except PacketInvalid as err:
-                log.info("Dropping invalid packet from %s:%d: %r", self.source.ip, self.source.port, err)
-                self.transport.close()
-                return
-            except Exception:
-                log.exception(f"Internal error: receive_packet for {type.name} triggered an exception")
-                self.transport.close()
-                return
+        return memoryview(self._buffer)[self._buffer_end :]
 
+    def buffer_updated(self, nbytes):
+        self._buffer_end += nbytes
+
+        if self.new_connection:
+            self._buffer_start = self._detect_source_ip_port(self._buffer[0 : self._buffer_end])
+            self.new_connection = False
+
+        # Packets are framed in place, and handed to the decoders straight
+        # from the receive buffer.
+        try:
+            self._buffer_start = self.receive_data(
+                self._dispatch_packet, self._buffer, self._buffer_start, self._buffer_end
+            )
+        except PacketInvalid as err:
+            log.info("Dropping invalid packet from %s:%d: %r", self.source.ip, self.source.port, err)
+            self.transport.close()
+            return
+
+        if self._buffer_start == self._buffer_end:
+            self._buffer_start = 0
+            self._buffer_end = 0
+
+            # The buffer only grows for big packets; don't keep it around.
+            if len(self._buffer) > RECEIVE_BUFFER_SIZE:
+                self._buffer = None
+
+    def _handle_packet(self, data, start, end):
+        # Once we are closing, there is no point in handling what is left.
+        if self.transport.is_closing():
+            return None
+
+        try:
+            dispatch, kwargs = self.receive_packet(self.source, data, start, end)
+        except PacketInvalid as err:
+            log.info("Dropping invalid packet from %s:%d: %r", self.source.ip, self.source.port, err)
+            self.transport.close()
+            return None
+        except Exception:
+            log.exception("Internal error: receive_packet() triggered an exception")
+            self.transport.close()
+            return None
+
+        try:
+            return dispatch.handler(self.source, **kwargs)
+        except SocketClosed:
+            # The other side is closing the connection; it can happen
+            # there is still some writes in the buffer, so force a close
+            # on our side too to free the resources.
+            self.transport.abort()
+        except Exception:
+            log.exception(f"Internal error: receive_{dispatch.type.name} triggered an exception")
+            self.transport.abort()
+
+        return None
+
+    def _dispatch_packet(self, data, start, end):
+        # While a handler is awaiting something, packets that arrive are
+        # queued behind it; this keeps the packets of a connection in order.
+        # As the receive buffer is reused, these packets have to be copied.
+        if self._pending is not None:
+            self._pending.append(data[start:end])
+            return
+
+        # Most handlers never need to wait, and run directly. Only if the
+        # handler has to await something, a task is created for it.
+        handler = self._handle_packet(data, start, end)
+        if iscoroutine(handler):
+            self._pending = collections.deque()
+            self.task = asyncio.create_task(self._process_pending(handler))
+
+    async def _process_pending(self, handler):
+        while True:
             try:
-                await getattr(self._callback, f"receive_{type.name}")(self.source, **kwargs)
+                await handler
             except SocketClosed:
                 # The other side is closing the connection; it can happen
                 # there is still some writes in the buffer, so force a close
@@ -128,10 +208,22 @@ class OpenTTDProtocolTCPStun(asyncio.Protocol, OpenTTDProtocolStunReceive):
                 # We were cancelled, meaning the connection was lost.
                 return
             except Exception:
-                log.exception(f"Internal error: receive_{type.name} triggered an exception")
+                log.exception(f"Internal error: {handler.__qualname__} triggered an exception")
                 self.transport.abort()
                 return
 
+            # Process the packets that arrived in the meantime, till one of
+            # them has to wait again.
+            while self._pending:
+                data = self._pending.popleft()
+                handler = self._handle_packet(data, 0, len(data))
+                if iscoroutine(handler):
+                    break
+            else:
+                self._pending = None
+                self.task = None
+                return
+
     async def send_packet(self, data):
         await self._can_write.wait()
 
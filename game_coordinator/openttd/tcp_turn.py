@@ -1,6 +1,11 @@
 import asyncio
 import click
+import collections
 import logging
+import os
+import socket
+import struct
+import time
 
 from asyncio.coroutines import iscoroutine
 from openttd_helpers import click_helper
@@ -9,35 +14,92 @@ from .protocol.exceptions import (
     PacketInvalid,
     SocketClosed,
 )
+from .protocol.read import (
+    RECEIVE_BUFFER_SIZE,
+    peek_uint16,
+)
 from .protocol.source import Source
 from .protocol.write import SEND_MTU
 from .receive import OpenTTDProtocolTurnReceive
 from .send import OpenTTDProtocolTurnSend
+from .shaper import Shaper
+from .splice import (
+    SpliceRelay,
+    is_splice_available,
+)
+from .timer_wheel import timer_wheel
 
 log = logging.getLogger(__name__)
 
+# Seconds between two checks whether a connection that can't be written to is closing.
+CHECK_CLOSED_INTERVAL = 5
+
+# Relays that keep filling their receive buffer get a bigger one, up to this size.
+RELAY_BUFFER_SIZE = 65536
+# Default memory a single relay (both directions) is allowed to buffer.
+RELAY_MEMORY = 2 * 1024 * 1024
+# Default memory all relays together are allowed to buffer.
+RELAY_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+
+# Offset of tcpi_rtt (in microseconds) in Linux' "struct tcp_info".
+_TCP_INFO_RTT_OFFSET = 68
+_tcp_info_rtt = struct.Struct("I")
+
+
+def _get_rtt(transport):
+    """Get the round-trip time (in seconds) of a connection, or None if unknown."""
+
+    if not hasattr(socket, "TCP_INFO"):
+        return None
 
-class OpenTTDProtocolTCPTurn(asyncio.Protocol, OpenTTDProtocolTurnReceive, OpenTTDProtocolTurnSend):
+    try:
+        info = transport.get_extra_info("socket").getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except OSError:
+        return None
+
+    if len(info) < _TCP_INFO_RTT_OFFSET + _tcp_info_rtt.size:
+        return None
+    return _tcp_info_rtt.unpack_from(info, _TCP_INFO_RTT_OFFSET)[0] / 1000000
+
+
+class OpenTTDProtocolTCPTurn(asyncio.BufferedProtocol, OpenTTDProtocolTurnReceive, OpenTTDProtocolTurnSend):
     proxy_protocol = False
+    # Till a relay is started, only a single packet is ever sent. Once it is
+    # started, the limits are tuned for the relay; see _tune_write_buffer().
+    write_buffer_limits = (SEND_MTU * 2, SEND_MTU)
+    splice = False
+    relay_memory = RELAY_MEMORY
+    relay_memory_budget = RELAY_MEMORY_BUDGET
+    shaper = Shaper()
 
     def __init__(self, callback_class):
         super().__init__()
 
         self._callback = callback_class
-        self._queue = asyncio.Queue()
-        self._data = b""
+        self._dispatch_table = self.get_dispatch_table(callback_class)
+        self._pending = None
+        self._buffer = None
+        self._buffer_start = 0
+        self._buffer_end = 0
         self.new_connection = True
         self.relay_peer = None
         self.relay_bytes = 0
+        self._relay_buffer_size = RELAY_BUFFER_SIZE
+        self._write_buffer_ceiling = 0
+        self._tuned_at = None
+        self._tuned_sent = 0
+        self._splice_relay = None
+        self._handling = b""
+        # Reasons reading is paused for; reading resumes once none is left.
+        self._read_paused = set()
+        self.relay_bucket = None
+        self.ip_bucket = None
 
-        self.task = asyncio.create_task(self._process_queue())
+        self.task = None
 
     def connection_made(self, transport):
         self.transport = transport
-        # Have a buffer of several packets, after which we expect it to drain to
-        # nearly empty before we start sending again. This reduces the memory
-        # this application uses drasticly on slow connections.
-        self.transport.set_write_buffer_limits(SEND_MTU * 5, SEND_MTU * 2)
+        self.transport.set_write_buffer_limits(*self.write_buffer_limits)
 
         self._can_write = asyncio.Event()
         self._can_write.set()
@@ -46,98 +108,295 @@ class OpenTTDProtocolTCPTurn(asyncio.Protocol, OpenTTDProtocolTurnReceive, OpenT
         self.source = Source(self, socket_addr, socket_addr[0], socket_addr[1])
 
     def connection_lost(self, exc):
+        if self._splice_relay:
+            self._splice_relay.stop()
+        if self.ip_bucket:
+            self.shaper.release_ip_bucket(self.source.ip)
+            self.ip_bucket = None
+
         getattr(self._callback, "disconnect")(self.source)
-        self.task.cancel()
+        if self.task:
+            self.task.cancel()
 
-    async def _check_closed(self):
-        while True:
-            # Asyncio doesn't notify us when the connection is closing, only
-            # when it is closed. Being in pause-writing means we have stuff
-            # in the buffer the client is not receiving. In asyncio language
-            # this means the transport is closing, but not closed. As such,
-            # we receive no "connection_lost" callback. Force this by resuming
-            # write operations, and on the next write it will trigger a
-            # SocketClosed exception, which triggers an abort() on the
-            # transport, releasing our resources. Yes. It is that complicated.
-            await asyncio.sleep(5)
-            if self.transport.is_closing():
-                self._can_write.set()
-                return
+    def _check_closed(self):
+        # Asyncio doesn't notify us when the connection is closing, only
+        # when it is closed. Being in pause-writing means we have stuff
+        # in the buffer the client is not receiving. In asyncio language
+        # this means the transport is closing, but not closed. As such,
+        # we receive no "connection_lost" callback. Force this by resuming
+        # write operations, and on the next write it will trigger a
+        # SocketClosed exception, which triggers an abort() on the
+        # transport, releasing our resources. Yes. It is that complicated.
+        if self.transport.is_closing():
+            self._can_write.set()
+            return
+
+        self._pause_timer = timer_wheel.call_later(CHECK_CLOSED_INTERVAL, self._check_closed)
 
     def pause_writing(self):
-        self._pause_task = asyncio.create_task(self._check_closed())
+        self._pause_timer = timer_wheel.call_later(CHECK_CLOSED_INTERVAL, self._check_closed)
         self._can_write.clear()
 
+        # Stop reading from our peer till we can write what it sends again.
+        if self.relay_peer:
+            self.relay_peer.protocol.pause_reading("peer")
+
     def resume_writing(self):
-        self._pause_task.cancel()
+        self._pause_timer.cancel()
         self._can_write.set()
 
+        if self.relay_peer:
+            self.relay_peer.protocol.resume_reading("peer")
+            self._tune_write_buffer()
+
+    def pause_reading(self, reason):
+        if not self._read_paused:
+            self.transport.pause_reading()
+        self._read_paused.add(reason)
+
+    def resume_reading(self, reason):
+        self._read_paused.discard(reason)
+        if not self._read_paused:
+            self.transport.resume_reading()
+
+    def is_reading_paused(self, reason):
+        return reason in self._read_paused
+
+    def throttle(self, delay):
+        """Stop reading for "delay" seconds, as this relay (or its IP) used up its bandwidth."""
+
+        if "shaper" in self._read_paused:
+            return
+
+        self.pause_reading("shaper")
+        asyncio.get_event_loop().call_later(delay, self.resume_reading, "shaper")
+
+    def get_relay_buffer_size(self):
+        return self._relay_buffer_size
+
+    def start_relay(self, relay_peer):
+        self.relay_peer = relay_peer
+
+        # Both directions of a relay share the bandwidth of the relay.
+        self.relay_bucket = relay_peer.protocol.relay_bucket or self.shaper.create_relay_bucket()
+        self.ip_bucket = self.shaper.acquire_ip_bucket(self.source.ip)
+
+        # Every direction of a relay buffers at most the receive buffer of
+        # the sender, and the write buffer of the receiver. The latter can
+        # overshoot its limit by one read before reading is paused. Split
+        # the memory of a direction over those.
+        direction_memory = self.relay_memory // 2
+        self._relay_buffer_size = max(RECEIVE_BUFFER_SIZE, min(RELAY_BUFFER_SIZE, direction_memory // 4))
+        self._write_buffer_ceiling = direction_memory - self._relay_buffer_size * 2
+
+        write_buffer_limit = min(SEND_MTU * 5, self._write_buffer_ceiling)
+        self.transport.set_write_buffer_limits(write_buffer_limit, write_buffer_limit // 2)
+
+    def _tune_write_buffer(self):
+        # Measure how fast the other side received since the last time the
+        # write buffer drained. For a relay not to stall while reading from
+        # its peer is paused, the low watermark should cover that rate for
+        # one round-trip. So aim for a high watermark of twice the
+        # bandwidth-delay product, within the memory this relay can use.
+        now = time.monotonic()
+        sent = self.relay_peer.protocol.relay_bytes - self.transport.get_write_buffer_size()
+        tuned_at, tuned_sent = self._tuned_at, self._tuned_sent
+        self._tuned_at, self._tuned_sent = now, sent
+        if tuned_at is None or now <= tuned_at:
+            return
+
+        rtt = _get_rtt(self.transport)
+        if not rtt:
+            return
+
+        _, high = self.transport.get_write_buffer_limits()
+        rate = (sent - tuned_sent) / (now - tuned_at)
+
+        write_buffer_limit = int(rate * rtt * 2)
+        write_buffer_limit = min(max(write_buffer_limit, RELAY_BUFFER_SIZE), self._write_buffer_ceiling)
+        if write_buffer_limit != high:
+            self.transport.set_write_buffer_limits(write_buffer_limit, write_buffer_limit // 2)
+
+    def detach(self):
+        """
+        Stop handling this connection, and return a duplicate of its socket,
+        together with everything received but not yet handled; starting with
+        the packet currently being handled.
+        """
+
+        self.transport.pause_reading()
+
+        data = self._handling + b"".join(self._pending or ())
+        if self._buffer is not None:
+            data += self._buffer[self._buffer_start : self._buffer_end]
+
+        if self._pending:
+            self._pending.clear()
+        self._buffer_start = 0
+        self._buffer_end = 0
+
+        fd = os.dup(self.transport.get_extra_info("socket").fileno())
+        self.transport.close()
+        return fd, data
+
+    def inject(self, data):
+        """Handle data as if it was received on this connection."""
+
+        data = memoryview(data)
+        while data:
+            buffer = self.get_buffer(-1)
+            length = min(len(buffer), len(data))
+            buffer[:length] = data[:length]
+            buffer.release()
+
+            self.buffer_updated(length)
+            data = data[length:]
+
+    def is_spliced(self):
+        return self._splice_relay is not None
+
+    def get_relay_memory(self):
+        buffer_size = len(self._buffer) if self._buffer is not None else 0
+        return buffer_size + self.transport.get_write_buffer_size()
+
     def _detect_source_ip_port(self, data):
         if not self.proxy_protocol:
-            return data
+            return 0
 
         # If enabled, expect new connections to start with PROXY. In this
         # header is the original source of the connection.
         if data[0:5] != b"PROXY":
             log.warning("Receive data without a proxy protocol header from %s:%d", self.source.ip, self.source.port)
-            return data
+            return 0
 
         # This message arrived via the proxy protocol; use the information
         # from this to figure out the real ip and port.
         proxy_end = data.find(b"\r\n")
         proxy = data[0:proxy_end].decode()
-        data = data[proxy_end + 2 :]
 
         # Example how 'proxy' looks:
         #  PROXY TCP4 127.0.0.1 127.0.0.1 33487 12345
 
         (_, _, ip, _, port, _) = proxy.split(" ")
         self.source = Source(self, self.source.addr, ip, int(port))
-        return data
+        return proxy_end + 2
+
+    def get_buffer(self, sizehint):
+        if self._buffer is None:
+            self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
+
+        # Relayed data is not framed; whatever is in the buffer is forwarded
+        # on the next read. What was left of a partial packet when the relay
+        # started can fill the buffer; make room for that read.
+        if self.relay_peer:
+            if self._buffer_end == len(self._buffer):
+                self._buffer.extend(bytes(RECEIVE_BUFFER_SIZE))
+            return memoryview(self._buffer)[self._buffer_end :]
+
+        # Move what is left of a partial packet to the front of the buffer.
+        if self._buffer_start:
+            length = self._buffer_end - self._buffer_start
+            self._buffer[0:length] = self._buffer[self._buffer_start : self._buffer_end]
+            self._buffer_start = 0
+            self._buffer_end = length
+
+        # Make sure the remainder of the packet fits in the buffer.
+        size = len(self._buffer)
+        if self._buffer_end >= 2:
+            size = max(size, peek_uint16(self._buffer))
+        if self._buffer_end == size:
+            size += RECEIVE_BUFFER_SIZE
+        if size > len(self._buffer):
+            self._buffer.extend(bytes(size - len(self._buffer)))
+
+        return memoryview(self._buffer)[self._buffer_end :]
+
+    def buffer_updated(self, nbytes):
+        self._buffer_end += nbytes
 
-    def data_received(self, data):
         if self.new_connection:
-            data = self._detect_source_ip_port(data)
+            self._buffer_start = self._detect_source_ip_port(self._buffer[0 : self._buffer_end])
             self.new_connection = False
 
-        self._data = self.receive_data(self._queue, self._data + data)
+        if self.relay_peer:
+            self._relay_buffer()
+            return
 
-    async def _process_queue(self):
-        while True:
-            data = await self._queue.get()
-
-            if self.relay_peer:
-                try:
-                    self.relay_bytes += len(data)
-                    await self.relay_peer.protocol.send_packet(data)
-                except SocketClosed:
-                    self.relay_peer.protocol.transport.close()
-                    return
-                except asyncio.CancelledError:
-                    # We were cancelled, meaning the connection was lost.
-                    return
-                except Exception:
-                    log.exception("Internal error: send_packet() triggered an exception")
-                    self.relay_peer.protocol.transport.abort()
-                    return
-                continue
+        # Packets are framed in place, and handed to the decoders straight
+        # from the receive buffer.
+        try:
+            self._buffer_start = self.receive_data(
+                self._dispatch_packet, self._buffer, self._buffer_start, self._buffer_end
+            )
+        except PacketInvalid as err:
+            log.info("Dropping invalid packet from %s:%d: %r", self.source.ip, self.source.port, err)
+            self.transport.close()
+            return
 
-            try:
-                type, kwargs = self.receive_packet(self.source, data)
-            except PacketInvalid as err:
-                log.info("Dropping invalid packet from %s:%d: %r", self.source.ip, self.source.port, err)
-                self.transport.close()
-                return
-            except asyncio.CancelledError:
-                # We were cancelled, meaning the connection was lost.
-                return
-            except Exception:
-                log.exception("Internal error: receive_packet() triggered an exception")
-                self.transport.abort()
-                return
+        if self._buffer_start == self._buffer_end:
+            self._buffer_start = 0
+            self._buffer_end = 0
+
+            # The buffer only grows for big packets; don't keep it around.
+            if len(self._buffer) > RECEIVE_BUFFER_SIZE:
+                self._buffer = None
+
+    def _handle_packet(self, data, start, end):
+        # Once we are closing, there is no point in handling what is left.
+        if self.transport.is_closing():
+            return None
+
+        if self.relay_peer:
+            self._relay(data[start:end])
+            return None
 
+        try:
+            dispatch, kwargs = self.receive_packet(self.source, data, start, end)
+        except PacketInvalid as err:
+            log.info("Dropping invalid packet from %s:%d: %r", self.source.ip, self.source.port, err)
+            self.transport.close()
+            return None
+        except Exception:
+            log.exception("Internal error: receive_packet() triggered an exception")
+            self.transport.close()
+            return None
+
+        # Keep the packet around; if the connection is handed over to
+        # another process, this packet has to be handled there again.
+        self._handling = bytes(data[start:end])
+
+        try:
+            return dispatch.handler(self.source, **kwargs)
+        except SocketClosed:
+            # The other side is closing the connection; it can happen
+            # there is still some writes in the buffer, so force a close
+            # on our side too to free the resources.
+            self.transport.abort()
+        except Exception:
+            log.exception(f"Internal error: receive_{dispatch.type.name} triggered an exception")
+            self.transport.abort()
+
+        return None
+
+    def _dispatch_packet(self, data, start, end):
+        # While a handler is awaiting something, packets that arrive are
+        # queued behind it; this keeps the packets of a connection in order.
+        # As the receive buffer is reused, these packets have to be copied.
+        if self._pending is not None:
+            self._pending.append(data[start:end])
+            return
+
+        # Most handlers never need to wait, and run directly. Only if the
+        # handler has to await something, a task is created for it.
+        handler = self._handle_packet(data, start, end)
+        if iscoroutine(handler):
+            self._pending = collections.deque()
+            self.task = asyncio.create_task(self._process_pending(handler))
+
+    async def _process_pending(self, handler):
+        while True:
             try:
-                await getattr(self._callback, f"receive_{type.name}")(self.source, **kwargs)
+                await handler
             except SocketClosed:
                 # The other side is closing the connection; it can happen
                 # there is still some writes in the buffer, so force a close
@@ -148,10 +407,81 @@ class OpenTTDProtocolTCPTurn(asyncio.Protocol, OpenTTDProtocolTurnReceive, OpenT
                 # We were cancelled, meaning the connection was lost.
                 return
             except Exception:
-                log.exception(f"Internal error: receive_{type.name} triggered an exception")
+                log.exception(f"Internal error: {handler.__qualname__} triggered an exception")
                 self.transport.abort()
                 return
 
+            # Process the packets that arrived in the meantime, till one of
+            # them has to wait again.
+            while self._pending:
+                data = self._pending.popleft()
+                handler = self._handle_packet(data, 0, len(data))
+                if iscoroutine(handler):
+                    break
+            else:
+                self._pending = None
+                self.task = None
+                return
+
+    def _relay_buffer(self):
+        data = self._buffer[self._buffer_start : self._buffer_end]
+
+        # A full buffer means more data is waiting; read bigger chunks.
+        size = len(self._buffer)
+        if self._buffer_end == size:
+            size *= 2
+        size = min(size, self._relay_buffer_size)
+        if size != len(self._buffer):
+            self._buffer = bytearray(size)
+
+        self._buffer_start = 0
+        self._buffer_end = 0
+
+        # Packets received before the relay was established might still be
+        # waiting for a handler; stay behind them.
+        if self._pending is not None:
+            self._pending.append(data)
+            return
+
+        if self.transport.is_closing():
+            return
+
+        self._relay(data)
+
+        # Spliced relays can't be shaped, as their data never passes by us.
+        if self.splice and not self.shaper.is_shaping():
+            self._start_splice()
+
+    def _relay(self, data):
+        # Once both sides are paired, the stream is forwarded as-is; there
+        # is no need to know where packets start or end. Flow control is
+        # done by pausing reading on this side when the peer can't keep up.
+        self.relay_bytes += len(data)
+
+        transport = self.relay_peer.protocol.transport
+        if not transport.is_closing():
+            transport.write(data)
+
+        self.shaper.take(self, len(data))
+
+    def _start_splice(self):
+        peer = self.relay_peer.protocol
+
+        # Only hand the sockets over to the kernel once nothing is left in
+        # any of the buffers on either side; otherwise data gets reordered.
+        for protocol in (self, peer):
+            if (
+                protocol._splice_relay is not None
+                or protocol._pending is not None
+                or protocol._buffer_end
+                or protocol.transport.is_closing()
+                or protocol.transport.get_write_buffer_size()
+            ):
+                return
+
+        self._splice_relay = peer._splice_relay = SpliceRelay(self, peer)
+        self._splice_relay.start()
+
     async def send_packet(self, data):
         await self._can_write.wait()
 
@@ -175,3 +505,65 @@ class OpenTTDProtocolTCPTurn(asyncio.Protocol, OpenTTDProtocolTurnReceive, OpenT
 )
 def click_turn_proxy_protocol(turn_proxy_protocol):
     OpenTTDProtocolTCPTurn.proxy_protocol = turn_proxy_protocol
+
+
+@click_helper.extend
+@click.option(
+    "--turn-splice",
+    help="Forward relayed TURN traffic in the kernel with splice() (Linux only). This saves CPU on bulk transfers, "
+    "like maps; not on the small packets of a running game.",
+    is_flag=True,
+)
+def click_turn_splice(turn_splice):
+    if turn_splice and not is_splice_available():
+        log.warning("splice() is not available on this system; relaying TURN traffic without it")
+        turn_splice = False
+
+    OpenTTDProtocolTCPTurn.splice = turn_splice
+
+
+@click_helper.extend
+@click.option(
+    "--turn-relay-memory",
+    help="Memory (in bytes) a single TURN relay is allowed to buffer.",
+    default=RELAY_MEMORY,
+    show_default=True,
+    type=click.IntRange(min=RECEIVE_BUFFER_SIZE * 8),
+)
+@click.option(
+    "--turn-relay-memory-budget",
+    help="Memory (in bytes) all TURN relays together are allowed to buffer; new relays are refused beyond this.",
+    default=RELAY_MEMORY_BUDGET,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+def click_turn_relay_memory(turn_relay_memory, turn_relay_memory_budget):
+    OpenTTDProtocolTCPTurn.relay_memory = turn_relay_memory
+    OpenTTDProtocolTCPTurn.relay_memory_budget = turn_relay_memory_budget
+
+
+@click_helper.extend
+@click.option(
+    "--turn-relay-rate",
+    help="Bandwidth (in bytes/sec) a single TURN relay (both directions) is allowed to use (0 for unlimited).",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--turn-ip-rate",
+    help="Bandwidth (in bytes/sec) all TURN relays of a single IP are allowed to send (0 for unlimited).",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--turn-total-rate",
+    help="Bandwidth (in bytes/sec) all TURN relays of a process together are allowed to use (0 for unlimited). "
+    "When reached, the bandwidth is shared fairly between relays.",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+def click_turn_shaping(turn_relay_rate, turn_ip_rate, turn_total_rate):
+    OpenTTDProtocolTCPTurn.shaper = Shaper(turn_relay_rate, turn_ip_rate, turn_total_rate)
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+# Resolution of the timers, in seconds.
+TICK = 0.1
+# Every level has this many slots; a slot of a level spans all slots of the
+# level below it.
+SLOTS_BITS = 6
+SLOTS = 1 << SLOTS_BITS
+SLOTS_MASK = SLOTS - 1
+# With 4 levels, timers can be up to 0.1 * 64 ** 4 seconds (~19 days) away;
+# timers further away are held in the last level till they come in range.
+LEVELS = 4
+# Number of ticks the slots of every level span together.
+_LEVEL_SPANS = [SLOTS << (SLOTS_BITS * level) for level in range(LEVELS)]
+
+
+class Timer:
+    __slots__ = ("deadline", "_wheel", "_slot", "_callback", "_args")
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.deadline = deadline
+        self._wheel = wheel
+        self._slot = None
+        self._callback = callback
+        self._args = args
+
+    def cancel(self):
+        if self._slot is None:
+            return
+
+        del self._slot[self]
+        self._slot = None
+        self._wheel._count -= 1
+
+
+class _Timeout:
+    def __init__(self, wheel, delay):
+        self._wheel = wheel
+        self._delay = delay
+        self._task = None
+        self._timer = None
+        self._expired = False
+
+    async def __aenter__(self):
+        self._task = asyncio.current_task()
+        self._timer = self._wheel.call_later(self._delay, self._expire)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._timer.cancel()
+
+        if self._expired and exc_type is asyncio.CancelledError:
+            # Python 3.11+ counts cancellations; this one is handled.
+            if hasattr(self._task, "uncancel"):
+                self._task.uncancel()
+            raise asyncio.TimeoutError
+
+    def _expire(self):
+        self._expired = True
+        self._task.cancel()
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel for all timeouts of the application.
+
+    Unlike with an asyncio timer (or task) per timeout, adding and
+    cancelling a timer is O(1), and all timers that expire in the same tick
+    are fired in a single batch. The wheel only ticks while timers are
+    pending.
+    """
+
+    def __init__(self):
+        self._levels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self._tick = 0
+        self._count = 0
+        self._handle = None
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+
+        # Idle wheels don't tick; catch up without going through all the
+        # ticks that passed.
+        if self._count == 0:
+            self._tick = int(now / TICK)
+
+        # Never fire early; round the deadline up to the next tick.
+        timer = Timer(self, max(math.ceil((now + delay) / TICK), self._tick + 1), callback, args)
+        self._add(timer)
+        self._count += 1
+
+        if self._handle is None:
+            self._schedule(loop)
+
+        return timer
+
+    def timeout(self, delay):
+        """
+        Async context manager to raise asyncio.TimeoutError if the block takes
+        longer than "delay"; like asyncio.wait_for(), without creating a task.
+        """
+
+        return _Timeout(self, delay)
+
+    async def sleep(self, delay):
+        future = asyncio.get_event_loop().create_future()
+        timer = self.call_later(delay, _resolve, future)
+        try:
+            await future
+        finally:
+            timer.cancel()
+
+    def _add(self, timer):
+        delta = timer.deadline - self._tick
+
+        for level, span in enumerate(_LEVEL_SPANS):
+            if delta < span:
+                index = (timer.deadline >> (SLOTS_BITS * level)) & SLOTS_MASK
+                break
+        else:
+            # Too far away; park it in the slot furthest away.
+            index = ((self._tick >> (SLOTS_BITS * level)) - 1) & SLOTS_MASK
+
+        slot = self._levels[level][index]
+        slot[timer] = None
+        timer._slot = slot
+
+    def _schedule(self, loop):
+        tick = self._tick + 1
+        self._handle = loop.call_at(tick * TICK, self._run, tick)
+
+    def _run(self, tick):
+        self._handle = None
+
+        # The event loop can run us a tiny bit early; so process at least
+        # the tick we were scheduled for.
+        loop = asyncio.get_event_loop()
+        now = max(int(loop.time() / TICK), tick)
+
+        while self._tick < now and self._count:
+            self._tick += 1
+            self._cascade()
+            self._fire()
+
+        if self._count:
+            self._schedule(loop)
+
+    def _cascade(self):
+        # Whenever a level wraps around, the next slot of the level above it
+        # is spread out over the levels below.
+        for level in range(1, LEVELS):
+            if self._tick & ((1 << (SLOTS_BITS * level)) - 1):
+                return
+
+            index = (self._tick >> (SLOTS_BITS * level)) & SLOTS_MASK
+            slot = self._levels[level][index]
+            self._levels[level][index] = {}
+
+            for timer in slot:
+                self._add(timer)
+
+    def _fire(self):
+        index = self._tick & SLOTS_MASK
+        slot = self._levels[0][index]
+        if not slot:
+            return
+        self._levels[0][index] = {}
+
+        for timer in list(slot):
+            # A callback can cancel other timers of this batch.
+            if timer._slot is None:
+                continue
+
+            timer._slot = None
+            self._count -= 1
+            try:
+                timer._callback(*timer._args)
+            except Exception:
+                log.exception("Internal error: timer callback triggered an exception")
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+timer_wheel = TimerWheel()
@@ -0,0 +1,142 @@
+import array
+import asyncio
+import logging
+import os
+import signal
+import socket
+import zlib
+
+from .protocol.source import Source
+
+log = logging.getLogger(__name__)
+
+# Biggest hand-over message; this is the packet being handled plus what
+# was received after it, which is at most a few packets.
+HANDOVER_SIZE = 262144
+
+
+class TurnWorkers:
+    """
+    Run the TURN server in several processes, all listening on the same port.
+
+    Both sides of a relay have to end up in the same process. The process
+    responsible for a token is picked by hashing the token. If a connection
+    arrives at another process, its socket is passed on to the right
+    process (via SCM_RIGHTS over a Unix socket), together with what was
+    received on it so far.
+
+    If a worker dies, the tokens it is responsible for can't be relayed
+    anymore; the parent notices this, and shuts down.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.index = None
+        self.failed = False
+
+        self._pids = []
+        # Every worker receives sockets on its own socketpair; every worker
+        # can send to any of them.
+        self._inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET) for _ in range(count)]
+
+    def fork(self):
+        """Fork the workers. Returns the index of the worker in a worker, and None in the parent."""
+
+        for index in range(self.count):
+            pid = os.fork()
+            if pid == 0:
+                self.index = index
+                for i, (receive, send) in enumerate(self._inboxes):
+                    if i != index:
+                        receive.close()
+                    # Never block the event loop on a worker that can't keep up.
+                    send.setblocking(False)
+                return index
+
+            self._pids.append(pid)
+
+        # Only the workers use the inboxes; this way a worker that dies
+        # closes its inbox, instead of it filling up.
+        for receive, send in self._inboxes:
+            receive.close()
+            send.close()
+
+        return None
+
+    def watch(self, on_failure):
+        """Call "on_failure" (in the parent) once a worker exits."""
+
+        asyncio.get_event_loop().add_signal_handler(signal.SIGCHLD, self._reap, on_failure)
+
+    def _reap(self, on_failure):
+        for pid in list(self._pids):
+            try:
+                exited, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                exited, status = pid, 0
+            if not exited:
+                continue
+
+            self._pids.remove(pid)
+            log.error("TURN worker (pid %d) exited with status %d", pid, status)
+
+            if not self.failed:
+                self.failed = True
+                on_failure()
+
+    def stop(self):
+        for pid in self._pids:
+            os.kill(pid, signal.SIGTERM)
+
+    def is_local(self, token):
+        return zlib.crc32(token.encode()) % self.count == self.index
+
+    def hand_over(self, source, token):
+        index = zlib.crc32(token.encode()) % self.count
+
+        fd, data = source.protocol.detach()
+        header = f"{source.ip} {source.port}\n".encode()
+        try:
+            self._inboxes[index][1].sendmsg(
+                [header + data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))]
+            )
+        except OSError as err:
+            # The worker is not keeping up (its inbox is full), or is gone;
+            # either way the connection is closed.
+            log.warning("Failed to hand over connection from %s to TURN worker %d: %r", source.ip, index, err)
+        finally:
+            os.close(fd)
+
+    def start(self, protocol_factory):
+        inbox = self._inboxes[self.index][0]
+        inbox.setblocking(False)
+        asyncio.get_event_loop().add_reader(inbox.fileno(), self._receive, inbox, protocol_factory)
+
+    def _receive(self, inbox, protocol_factory):
+        fds = array.array("i")
+        try:
+            message, ancdata, _, _ = inbox.recvmsg(HANDOVER_SIZE, socket.CMSG_LEN(fds.itemsize))
+        except BlockingIOError:
+            return
+
+        for level, type, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[: len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+        if len(fds) != 1:
+            log.error("Received hand-over without a socket")
+            for fd in fds:
+                os.close(fd)
+            return
+
+        asyncio.create_task(self._adopt(socket.socket(fileno=fds[0]), message, protocol_factory))
+
+    async def _adopt(self, sock, message, protocol_factory):
+        header, _, data = message.partition(b"\n")
+        ip, port = header.decode().split(" ")
+
+        _, protocol = await asyncio.get_event_loop().connect_accepted_socket(protocol_factory, sock=sock)
+
+        # The other worker already read the proxy protocol header, if any.
+        protocol.new_connection = False
+        protocol.source = Source(protocol, protocol.source.addr, ip, int(port))
+        protocol.inject(data)